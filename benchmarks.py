@@ -0,0 +1,242 @@
+"""
+Micro-benchmarks for the powersorter scripts.
+Each benchmark compares the current implementation against the approach it replaced
+using synthetic file names built from a config file.
+Example:
+python benchmarks.py classifier -c config/BRIT_v3.json -n 2000000
+python benchmarks.py url_gen -c config/BRIT_v3.json -n 2000000
+python benchmarks.py url_translator -c config/BRIT_v3.json -n 2000000
+"""
+
+import argparse
+import gc
+import os
+import random
+import re
+import time
+import tracemalloc
+
+import powersorter
+import url_gen
+
+# file name endings used for synthetic file names, roughly in the proportions seen in staging
+NAME_ENDINGS = ['.jpg', '_med.jpg', '_thumb.jpg', '.dng', '_ocr.txt', '.JPG', '.tif', '.CR2', '_ocr.json']
+
+def synthetic_names(count=None, prefix=None, seed=0):
+    """
+    Generate count synthetic file names, mostly matching file names
+    with collection prefix and some that don't match any file type.
+    """
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        roll = rng.random()
+        numerical = rng.randrange(1, 2000000)
+        if roll < 0.1:
+            names.append(f'IMG_{numerical}.JPG')
+        elif roll < 0.15:
+            names.append(f'{prefix}{numerical}_notes.docx')
+        else:
+            names.append(prefix + str(numerical) + rng.choice(NAME_ENDINGS))
+    return names
+
+def timed(function=None, names=None):
+    # as timeit does, so results kept from an earlier run don't slow later ones with collections
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = function(names)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+def benchmark_classifier(settings=None, count=None):
+    """
+    Compare FileClassifier against matching each file type pattern in turn.
+    """
+    classifier = powersorter.FileClassifier(catalog_number_regex=settings.catalog_number_regex, \
+        file_types=settings.file_types, \
+        precedence=settings.file_type_precedence, \
+        prefix=settings.collection_prefix)
+    names = synthetic_names(count=count, prefix=classifier.prefix or settings.collection_prefix)
+    # compiled once per file type, as scan_files did before the classifier
+    file_patterns = [(file_type, re.compile(pattern)) for file_type, pattern in classifier.patterns]
+
+    def per_type_loop(names):
+        matches = []
+        for name in names:
+            for file_type, file_pattern in file_patterns:
+                m = file_pattern.match(name)
+                if m:
+                    matches.append((file_type, m.groupdict()))
+                    break
+        return matches
+
+    def union_classifier(names):
+        match = classifier.match
+        matches = []
+        for name in names:
+            m = match(name)
+            if m:
+                matches.append(m)
+        return matches
+
+    loop_time, loop_matches = timed(per_type_loop, names)
+    union_time, union_matches = timed(union_classifier, names)
+    if loop_matches != union_matches:
+        print('ERROR - classifier results differ from per-type loop')
+    print(f'names: {count} matches: {len(union_matches)}')
+    print(f'per-type re.match loop: {loop_time:.2f}s ({loop_time / count * 1e9:.0f} ns/name)')
+    print(f'FileClassifier:         {union_time:.2f}s ({union_time / count * 1e9:.0f} ns/name)')
+    print(f'speedup: {loop_time / union_time:.2f}x')
+
+def measure_memory(build=None, names=None):
+    """
+    Return (bytes, seconds) retained and taken by build(names).
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build(names)
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return size, elapsed
+
+def benchmark_records(settings=None, count=None):
+    """
+    Compare memory used per matching file by FileMatch records
+    and by the dicts scan_files used to build.
+    """
+    classifier = powersorter.FileClassifier(catalog_number_regex=settings.catalog_number_regex, \
+        file_types=settings.file_types, \
+        precedence=settings.file_type_precedence, \
+        prefix=settings.collection_prefix)
+    names = synthetic_names(count=count, prefix=classifier.prefix or settings.collection_prefix)
+    # files are spread over directories of 1000 files, as listed by the scan
+    root = settings.files.get('input_path', None) or '/staging'
+    directories = [os.path.join(root, f'batch_{i:05d}') for i in range(count // 1000 + 1)]
+
+    def file_dicts(names):
+        matches = []
+        for i, name in enumerate(names):
+            m = classifier.match(name)
+            if m:
+                file_type, file_dict = m
+                file_dict['file_path'] = os.path.join(directories[i // 1000], name)
+                file_dict['file_type'] = file_type
+                matches.append(file_dict)
+        return matches
+
+    def file_matches(names):
+        matches = []
+        for i, name in enumerate(names):
+            m = classifier.classify(directory=directories[i // 1000], name=name)
+            if m:
+                matches.append(m)
+        return matches
+
+    match_count = len(file_matches(names))
+    dict_size, dict_time = measure_memory(build=file_dicts, names=names)
+    record_size, record_time = measure_memory(build=file_matches, names=names)
+    print(f'names: {count} matches: {match_count}')
+    print(f'dict per file:      {dict_size / match_count:.0f} bytes ({dict_time:.2f}s)')
+    print(f'FileMatch per file: {record_size / match_count:.0f} bytes ({record_time:.2f}s)')
+    print(f'memory reduction: {dict_size / record_size:.2f}x')
+
+def benchmark_url_gen(settings=None, count=None):
+    """
+    Compare url_gen's WebImageClassifier against compiling and matching all three
+    web image patterns for each log row, as url_gen.match_pattern did.
+    """
+    image_classifier = url_gen.WebImageClassifier(settings=settings)
+    names = synthetic_names(count=count, prefix=image_classifier.classifier.prefix or settings.collection_prefix)
+    # scoped so configs with inline flags compile on Python 3.11+, as the classifier's patterns are
+    web_patterns = [powersorter.scope_inline_flags(settings.catalog_number_regex \
+        + settings.file_types[file_type]['file_regex']) for file_type in url_gen.WEB_IMAGE_FILE_TYPES]
+
+    def match_pattern_per_row(names):
+        matches = []
+        for name in names:
+            full, medium, thumb = [re.compile(pattern).match(name) for pattern in web_patterns]
+            match = full or medium or thumb
+            if match:
+                match_dict = match.groupdict()
+                matches.append((match_dict.get('size', 'large'), match_dict))
+        return matches
+
+    def web_image_classifier(names):
+        match = image_classifier.match
+        matches = []
+        for name in names:
+            m = match(name)
+            if m:
+                matches.append(m)
+        return matches
+
+    row_time, row_matches = timed(match_pattern_per_row, names)
+    classifier_time, classifier_matches = timed(web_image_classifier, names)
+    if row_matches != classifier_matches:
+        print('ERROR - WebImageClassifier results differ from match_pattern')
+    print(f'names: {count} matches: {len(classifier_matches)}')
+    print(f'match_pattern per row: {row_time:.2f}s ({row_time / count * 1e9:.0f} ns/name)')
+    print(f'WebImageClassifier:    {classifier_time:.2f}s ({classifier_time / count * 1e9:.0f} ns/name)')
+    print(f'speedup: {row_time / classifier_time:.2f}x')
+
+def benchmark_url_translator(settings=None, count=None):
+    """
+    Compare url_gen's UrlTranslator against calling generate_url for each file,
+    for files sorted into folders of folder_increment files under web_base.
+    """
+    web_base = settings.collection.get('web_base', None) or '/web'
+    url_base = settings.collection.get('url_base', None) or 'https://example.org/web/'
+    names = synthetic_names(count=count, prefix=settings.collection_prefix)
+    numbers = [int(re.sub(r'\D', '', name) or 0) for name in names]
+    paths = [os.path.join(web_base, settings.collection_prefix \
+        + str(number // settings.folder_increment * settings.folder_increment).zfill(settings.number_pad), name) \
+        for name, number in zip(names, numbers)]
+    # a few files outside web_base, which generate_url maps relative to their common path
+    paths[::1000] = [os.path.join('/outside', name) for name in names[::1000]]
+
+    def generate_url_per_file(paths):
+        return [url_gen.generate_url(file_base_path=web_base, file_path=path, url_base=url_base) for path in paths]
+
+    def url_translator(paths):
+        url = url_gen.UrlTranslator(web_base=web_base, url_base=url_base).url
+        return [url(path) for path in paths]
+
+    function_time, function_urls = timed(generate_url_per_file, paths)
+    translator_time, translator_urls = timed(url_translator, paths)
+    if function_urls != translator_urls:
+        print('ERROR - UrlTranslator results differ from generate_url')
+    print(f'paths: {count}')
+    print(f'generate_url:  {function_time:.2f}s ({function_time / count * 1e9:.0f} ns/path)')
+    print(f'UrlTranslator: {translator_time:.2f}s ({translator_time / count * 1e9:.0f} ns/path)')
+    print(f'speedup: {function_time / translator_time:.2f}x')
+
+BENCHMARKS = {
+    'classifier': benchmark_classifier,
+    'records': benchmark_records,
+    'url_gen': benchmark_url_gen,
+    'url_translator': benchmark_url_translator,
+}
+
+def arg_setup():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("benchmark", choices=sorted(BENCHMARKS), \
+        help="Name of the benchmark to run.")
+    ap.add_argument("-c", "--config", required=True, \
+        help="Path to the configuration file providing patterns.")
+    ap.add_argument("-n", "--count", type=int, default=2000000, \
+        help="Number of synthetic file names.")
+    args = vars(ap.parse_args())
+    return args
+
+if __name__ == '__main__':
+    args = arg_setup()
+    settings = powersorter.Settings()
+    settings.load_config(config_file=args['config'])
+    BENCHMARKS[args['benchmark']](settings=settings, count=args['count'])
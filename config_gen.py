@@ -53,9 +53,15 @@ web_jpg_thumb['output_sub_path'] = 'web/TEST/'
 archive_dng = file_types['archive_dng'] = {}
 archive_dng['file_regex'] = r'(_(?P<suffix>.+))*(\.)(?i)(?P<ext>dng)'
 archive_dng['output_sub_path'] = 'archive/TEST/'
+archive_dng['manifest'] = True
 
 ocr = file_types['ocr'] = {}
 ocr['file_regex'] = r'(_(?P<suffix>.+))*(_ocr)(\.)(?i)(?P<ext>txt|json)'
 ocr['output_sub_path'] = 'web/TEST/'
 
+# Optional order in which file type patterns are tested.
+# A file matching more than one file type is sorted as the first type listed.
+# File types not listed are tested afterwards in the order above.
+config['file_type_precedence'] = ['web_jpg_med', 'web_jpg_thumb', 'ocr', 'web_jpg', 'archive_dng']
+
 print(json.dumps(config, indent=4))
@@ -0,0 +1,104 @@
+"""
+log_merge combines the CSV logs written by the shards of a powersorter run
+(powersorter.py --shard i/N) into one run log, in timestamp order.
+Logs may be gzip compressed, the merged log is compressed if its name ends in .gz.
+The SQLite log databases written by shards with --log_db can be merged the same way,
+their rows include the run_id of each shard's run.
+Example:
+python log_merge.py -o logs/BRIT_2023-05-01T120000.csv logs/BRIT_2023-05-01T12*_shard*of4.csv
+python log_merge.py -o logs/BRIT_log_merged.csv logs/BRIT_log_shard*of4.sqlite
+"""
+
+import argparse
+import csv
+import glob
+import gzip
+import heapq
+import sqlite3
+
+def open_log(path=None, mode='r'):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', newline='')
+    return open(path, mode, newline='')
+
+def is_log_database(path=None):
+    return str(path).endswith(('.sqlite', '.db'))
+
+def read_fieldnames(path=None):
+    if is_log_database(path):
+        connection = sqlite3.connect(path)
+        try:
+            return [column[1] for column in connection.execute('PRAGMA table_info(moves)')]
+        finally:
+            connection.close()
+    with open_log(path) as f:
+        return next(csv.reader(f), [])
+
+def read_rows(path=None):
+    """
+    Yield the rows of a log as (timestamp, row).
+    Rows of a log database are read in the order they were logged, as in a CSV log.
+    """
+    if is_log_database(path):
+        connection = sqlite3.connect(path)
+        connection.row_factory = sqlite3.Row
+        try:
+            for row in connection.execute('SELECT * FROM moves ORDER BY rowid'):
+                yield row['timestamp'], dict(row)
+        finally:
+            connection.close()
+        return
+    with open_log(path) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield row['timestamp'], row
+
+def merge_logs(log_paths=None, output_path=None):
+    """
+    Merge logs into output_path. Each shard's log is already in the order its moves
+    were logged, so logs are merged as they are read rather than sorted in memory.
+    Rows with the same timestamp are kept in the order the logs are given.
+    Returns the number of rows and the number of successful moves of each log.
+    """
+    fieldnames = []
+    for path in log_paths:
+        for fieldname in read_fieldnames(path=path):
+            if fieldname not in fieldnames:
+                fieldnames.append(fieldname)
+    counts = {path: {'rows': 0, 'success': 0} for path in log_paths}
+
+    def counted(path=None):
+        for timestamp, row in read_rows(path=path):
+            counts[path]['rows'] += 1
+            if row.get('result', None) == 'success':
+                counts[path]['success'] += 1
+            yield timestamp, row
+
+    with open_log(output_path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for timestamp, row in heapq.merge(*(counted(path=path) for path in log_paths), key=lambda item: item[0]):
+            writer.writerow(row)
+    return counts
+
+def arg_setup():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("logs", nargs="+", \
+        help="Paths or glob patterns of the shard logs or log databases to merge.")
+    ap.add_argument("-o", "--output", required=True, \
+        help="Path of the merged log.")
+    args = vars(ap.parse_args())
+    return args
+
+if __name__ == '__main__':
+    args = arg_setup()
+    log_paths = []
+    for pattern in args['logs']:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        log_paths.extend(path for path in matches if path not in log_paths)
+    counts = merge_logs(log_paths=log_paths, output_path=args['output'])
+    for path, count in counts.items():
+        print(path, 'rows', count['rows'], 'success', count['success'])
+    print('rows', sum(count['rows'] for count in counts.values()), \
+        'success', sum(count['success'] for count in counts.values()))
+    print('Merged log written to:', args['output'])
@@ -9,60 +9,1231 @@ import pwd
 import argparse
 import datetime
 import sys
-
-print('STARTING')
+import queue
+import threading
+import collections
+import concurrent.futures
+import sqlite3
+import time
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import errno
+import gzip
+import atexit
+import hashlib
 
 CONFIG_FORMAT_REQUIRED = '3.0'
 sorted_file_count = 0
 unmoved_file_count = 0
+# maximum number of files waiting between stages of the sort pipeline
+QUEUE_SIZE = 1000
+# matching files passed on at a time by each scanning thread
+SCAN_BATCH_SIZE = 100
+# threads creating destination directories
+DIRECTORY_WORKERS = 4
+# maximum number of files moved between log flushes in watch mode
+WATCH_BATCH_SIZE = 100
+# bytes copied per call when copying files between filesystems in the kernel
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# log rows written to the log file at a time, and seconds between log flushes
+LOG_BATCH_SIZE = 1000
+LOG_FLUSH_INTERVAL = 1.0
+# columns of the moves table of the SQLite log, indexed columns are listed in LOG_DATABASE_INDEXES
+LOG_DATABASE_COLUMNS = ['run_id', 'timestamp', 'username', 'action', 'result', 'details', 'filetype', \
+    'catalog_number', 'source', 'destination', 'move_method', 'bytes_copied', 'sha256']
+LOG_DATABASE_INDEXES = ['result', 'filetype', 'catalog_number', 'run_id']
+# bytes read per call when hashing files
+HASH_CHUNK_SIZE = 1024 * 1024
+# checksum manifest written in destination directories of file types with "manifest": true
+MANIFEST_FILENAME = 'SHA256SUMS'
+
+# inline global flags such as (?i), which Python 3.11+ only accepts at the start of a pattern
+INLINE_FLAGS_PATTERN = re.compile(r'(?<!\\)\(\?([aiLmsux]+)\)')
+# named groups of the file patterns kept for each matching file
+MATCH_FIELDS = ('catNum', 'numerical', 'suffix', 'size', 'ext')
+EXTENSION_GROUP_PATTERN = re.compile(r'\(\?P<ext>([A-Za-z0-9|]+)\)(?![?*{])')
+# opening groups then literal text at the start of a catalog number pattern
+LEADING_LITERAL_PATTERN = re.compile(r'(?:\(\?P<\w+>|\((?!\?))*([A-Za-z0-9_-]*)')
+
+def split_inline_flags(pattern=None):
+    """
+    Return (flags, pattern) with inline global flags removed from pattern.
+    """
+    flags = ''.join(sorted(set(''.join(INLINE_FLAGS_PATTERN.findall(pattern)))))
+    return flags, INLINE_FLAGS_PATTERN.sub('', pattern)
+
+def scope_inline_flags(pattern=None):
+    """
+    Rewrite a pattern so inline global flags apply to the whole pattern
+    as a scoped group, e.g. 'BRIT\\d+(\\.)(?i)(?P<ext>jpg)' becomes
+    '(?i:BRIT\\d+(\\.)(?P<ext>jpg))'. Older versions of Python applied a
+    mid-pattern (?i) to the whole pattern, this keeps that behaviour
+    and allows the pattern to be combined with others.
+    """
+    flags, pattern = split_inline_flags(pattern)
+    if not flags:
+        return pattern
+    return f'(?{flags}:{pattern})'
+
+def literal_prefix(catalog_number_regex=None, prefix=None):
+    """
+    Return prefix if every match of catalog_number_regex has to start with it, otherwise ''.
+    Only the text of the pattern is checked: after any opening groups it must
+    start with prefix, not followed by a quantifier, and have no alternatives.
+    """
+    if not prefix or '|' in catalog_number_regex:
+        return ''
+    flags, pattern = split_inline_flags(catalog_number_regex)
+    m = LEADING_LITERAL_PATTERN.match(pattern)
+    literal = m.group(1)
+    rest = pattern[m.end():]
+    if rest[:1] in ('?', '*', '+', '{'):
+        # the quantifier applies to the last character
+        literal = literal[:-1]
+    elif rest.lstrip(')')[:1] in ('?', '*', '+', '{'):
+        # the quantifier applies to a group holding the literal
+        return ''
+    if 'i' in flags:
+        literal, prefix = literal.casefold(), prefix.casefold()
+    if not literal.startswith(prefix):
+        return ''
+    return prefix
+
+class FileMatch():
+    """
+    A file matching a file type, with the parts of its name used for sorting.
+    Uses __slots__ instead of a dict per file. The directory string is shared
+    by all files found in the same directory, file_type and ext are interned
+    and numerical is an integer.
+    """
+    __slots__ = ('directory', 'name', 'file_type', 'catalog_number', 'numerical', 'suffix', 'size', 'ext', \
+        'destination_directory')
+
+    def __init__(self, directory=None, name=None, file_type=None, catalog_number=None, numerical=None, \
+        suffix=None, size=None, ext=None):
+        self.directory = directory
+        self.name = name
+        self.file_type = file_type
+        self.catalog_number = catalog_number
+        self.numerical = numerical
+        self.suffix = suffix
+        self.size = size
+        self.ext = ext
+        self.destination_directory = None
+
+    @property
+    def file_path(self):
+        return os.path.join(self.directory, self.name)
+
+class FileClassifier():
+    """
+    Classify file names by file type using a single compiled pattern.
+    The pattern for each file type (catalog_number_regex + file_regex) is
+    a named branch of one alternation, tested in order of precedence.
+    This gives the same results as testing each file type in turn.
+    Names are checked against the collection prefix, if every catalog number
+    starts with it, and the file extensions before the pattern is used.
+    """
+    def __init__(self, catalog_number_regex=None, file_types=None, precedence=None, prefix=None):
+        self.file_types = order_file_types(file_types=file_types, precedence=precedence)
+        self.patterns = []
+        extensions = set()
+        self.ignore_case = False
+        for file_type in self.file_types:
+            file_regex = file_types[file_type].get('file_regex', None)
+            flags, pattern = split_inline_flags(catalog_number_regex + file_regex)
+            self.ignore_case = self.ignore_case or 'i' in flags
+            pattern = scope_inline_flags(catalog_number_regex + file_regex)
+            self.patterns.append((file_type, pattern))
+            extension_group = EXTENSION_GROUP_PATTERN.search(pattern)
+            if extensions is not None and extension_group:
+                extensions.update(ext.casefold() for ext in extension_group.group(1).split('|') if ext)
+            else:
+                extensions = None
+        pattern = '|'.join(f'(?P<file_type__{index}>{self.rename_groups(branch_pattern, index)})' \
+            for index, (file_type, branch_pattern) in enumerate(self.patterns))
+        self.pattern = re.compile(pattern)
+        self.branches = {}
+        group_names = sorted(self.pattern.groupindex.items(), key=lambda item: item[1])
+        for index, file_type in enumerate(self.file_types):
+            suffix = f'__{index}'
+            branch_index = self.pattern.groupindex['file_type' + suffix]
+            groups = [(name[:-len(suffix)] if name.endswith(suffix) else name, group_index) \
+                for name, group_index in group_names \
+                if group_index != branch_index and name.endswith(suffix)]
+            names = tuple(name for name, group_index in groups)
+            indexes = tuple(group_index for name, group_index in groups)
+            # groups kept by FileMatch, None if the file type doesn't have the group
+            fields = tuple(dict(groups).get(name, None) for name in MATCH_FIELDS)
+            # file_type is interned so all matches share one string per type
+            self.branches[branch_index] = (sys.intern(file_type), names, indexes, fields)
+        self.prefix = literal_prefix(catalog_number_regex=catalog_number_regex, prefix=prefix)
+        self.folded_prefix = self.prefix.casefold()
+        # Extension filter is only used if every pattern has a plain (?P<ext>a|b) group
+        self.extensions = tuple(sorted(extensions)) if extensions else None
+
+    @staticmethod
+    def rename_groups(pattern=None, index=None):
+        # group names must be unique across the branches of the combined pattern
+        return re.sub(r'\(\?P([<=])(\w+)', rf'(?P\1\2__{index}', pattern)
+
+    def match_pattern(self, name=None):
+        """
+        Return the match object for name, or None if it doesn't match any file type.
+        """
+        if not name.startswith(self.prefix):
+            if not self.ignore_case or not name.casefold().startswith(self.folded_prefix):
+                return None
+        if self.extensions:
+            lowered = name.casefold()
+            for ext in self.extensions:
+                if ext in lowered:
+                    break
+            else:
+                return None
+        return self.pattern.match(name)
+
+    def match(self, name=None):
+        """
+        Return (file_type, groupdict) for the first file type matching name,
+        or None if name doesn't match any file type.
+        """
+        m = self.match_pattern(name)
+        if m is None:
+            return None
+        file_type, names, indexes, fields = self.branches[m.lastindex]
+        if len(indexes) == 1:
+            return file_type, {names[0]: m.group(indexes[0])}
+        return file_type, dict(zip(names, m.group(*indexes)))
 
-def scan_files(path=None, pattern=None, file_type=None):
+    def classify(self, directory=None, name=None):
+        """
+        Return a FileMatch for a file in directory, or None if name doesn't match any file type.
+        """
+        m = self.match_pattern(name)
+        if m is None:
+            return None
+        file_type, names, indexes, fields = self.branches[m.lastindex]
+        catalog_number, numerical, suffix, size, ext = [group_index and m.group(group_index) for group_index in fields]
+        if numerical is not None:
+            numerical = int(numerical)
+        if ext is not None:
+            ext = sys.intern(ext)
+        return FileMatch(directory=directory, name=name, file_type=file_type, catalog_number=catalog_number, \
+            numerical=numerical, suffix=suffix, size=size, ext=ext)
+
+class ScanIndex():
+    """
+    Record of the directories scanned by previous runs, kept in a SQLite database.
+    For each directory the modification time, subdirectories, and the names of
+    files that did and did not match a file type are stored. A directory whose
+    modification time hasn't changed since it was recorded isn't listed again,
+    its subdirectories are taken from the index and its matching files reused.
+    The index is cleared when the file type patterns change.
     """
-    Scan the directory for files matching the provided pattern.
+    # directories modified this close to the start of the run are not trusted,
+    # they could change again within the timestamp resolution of the filesystem
+    MTIME_MARGIN_NS = 2 * 1000000000
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path=None, fingerprint=None):
+        self.path = path
+        self.started_ns = time.time_ns()
+        self.lock = threading.Lock()
+        self.pending_updates = 0
+        self.reused_count = 0
+        self.listed_count = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS index_settings (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, \
+            subdirectories TEXT, matched TEXT, unmatched TEXT)')
+        row = self.connection.execute("SELECT value FROM index_settings WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            self.connection.execute('DELETE FROM directories')
+            self.connection.execute("INSERT OR REPLACE INTO index_settings (key, value) VALUES ('fingerprint', ?)", \
+                (fingerprint,))
+        self.connection.commit()
+
+    def lookup(self, path=None):
+        """
+        Return (mtime_ns, subdirectories, matched, unmatched) recorded for a directory, or None.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT mtime_ns, subdirectories, matched, unmatched \
+                FROM directories WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        mtime_ns, subdirectories, matched, unmatched = row
+        return mtime_ns, json.loads(subdirectories), json.loads(matched), set(json.loads(unmatched))
+
+    def record(self, path=None, mtime_ns=None, subdirectories=None, matched=None, unmatched=None):
+        """
+        Record the listing of a directory. Directories modified too recently
+        are recorded without a modification time so they are listed again next run.
+        """
+        if mtime_ns is not None and mtime_ns > self.started_ns - self.MTIME_MARGIN_NS:
+            mtime_ns = None
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO directories \
+                (path, mtime_ns, subdirectories, matched, unmatched) VALUES (?, ?, ?, ?, ?)', \
+                (path, mtime_ns, json.dumps(subdirectories), json.dumps(matched), json.dumps(unmatched)))
+            self.listed_count += 1
+            self.pending_updates += 1
+            if self.pending_updates >= self.COMMIT_INTERVAL:
+                self.connection.commit()
+                self.pending_updates = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class DigestCache():
+    """
+    Cache of sha256 digests of files kept in a SQLite database, keyed by path,
+    size and modification time, so unchanged files are only hashed once across runs.
+    Only digests of files already in the destination directories are cached.
+    """
+    # files modified this close to the start of the run are not cached,
+    # they could change again within the timestamp resolution of the filesystem
+    MTIME_MARGIN_NS = ScanIndex.MTIME_MARGIN_NS
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path=None):
+        self.path = path
+        self.started_ns = time.time_ns()
+        self.lock = threading.Lock()
+        self.pending_updates = 0
+        self.hashed_count = 0
+        self.cached_count = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER, \
+            mtime_ns INTEGER, sha256 TEXT)')
+        self.connection.commit()
+
+    def digest(self, path=None, stat=None):
+        """
+        Return the sha256 hex digest of a file, given the result of os.stat for it.
+        """
+        path = os.fspath(path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, sha256 FROM digests WHERE path = ?', \
+                (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            with self.lock:
+                self.cached_count += 1
+            return row[2]
+        digest = hash_file(path)
+        with self.lock:
+            self.hashed_count += 1
+            if stat.st_mtime_ns <= self.started_ns - self.MTIME_MARGIN_NS:
+                self.connection.execute('INSERT OR REPLACE INTO digests (path, size, mtime_ns, sha256) \
+                    VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, digest))
+                self.pending_updates += 1
+                if self.pending_updates >= self.COMMIT_INTERVAL:
+                    self.connection.commit()
+                    self.pending_updates = 0
+        return digest
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+def classifier_fingerprint(classifier=None):
+    """
+    Identify the file type patterns of a classifier, so stored results
+    are only reused with the same patterns.
+    """
+    return json.dumps(classifier.patterns)
+
+class ScannedDirectory():
+    """
+    Marks the end of the files of a directory in the files yielded by scan_files.
+    """
+    __slots__ = ('path', 'subdirectories')
+
+    def __init__(self, path=None, subdirectories=None):
+        self.path = path
+        self.subdirectories = subdirectories
+
+def scan_directory(path=None, classifier=None, index=None, preflight=None, subdirectories=None):
+    """
+    List a single directory with os.scandir and classify the files in it.
+    Directories are treated as os.walk treats them, symbolic links to
+    directories are listed but not scanned and unreadable directories are skipped.
+    If a scan index is used, a directory unchanged since it was recorded
+    isn't listed and only files not seen before are classified.
+    If a preflight is given, each matching file's DirEntry is passed to it for checking
+    and files that fail the check are left out of the matching files.
+    Yields each matching file as the directory is listed and appends the subdirectories
+    to scan to subdirectories. File names are only kept to record them in the scan index.
+    """
+    known_unmatched = set()
+    if index is not None:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+        recorded = index.lookup(path=path)
+        if recorded is not None:
+            recorded_mtime_ns, subdirectory_names, matched, known_unmatched = recorded
+            if recorded_mtime_ns == mtime_ns:
+                with index.lock:
+                    index.reused_count += 1
+                subdirectories.extend(os.path.join(path, name) for name in subdirectory_names)
+                for name in matched:
+                    file_match = classifier.classify(directory=path, name=name)
+                    if file_match:
+                        yield file_match
+                return
+        matched = []
+        unmatched = []
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    subdirectories.append(entry.path)
+                continue
+            if entry.name in known_unmatched:
+                unmatched.append(entry.name)
+                continue
+            file_match = classifier.classify(directory=path, name=entry.name)
+            if file_match:
+                if index is not None:
+                    matched.append(entry.name)
+                if preflight is not None and not preflight.check_source(entry=entry, file_match=file_match):
+                    continue
+                yield file_match
+            elif index is not None:
+                unmatched.append(entry.name)
+    if index is not None:
+        index.record(path=path, mtime_ns=mtime_ns, \
+            subdirectories=[os.path.basename(subdirectory) for subdirectory in subdirectories], \
+            matched=matched, unmatched=unmatched)
+
+def walk_directories(path=None, classifier=None, index=None, scanned=None, preflight=None):
+    """
+    Scan path and its subdirectories one at a time, in the same order as os.walk.
+    Subdirectories in scanned aren't scanned.
+    Yields the matching files of each directory as it is listed, then a ScannedDirectory for it.
+    """
+    directories = [os.fspath(path)]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        yield from scan_directory(path=directory, classifier=classifier, index=index, preflight=preflight, \
+            subdirectories=subdirectories)
+        directories.extend(subdirectory for subdirectory in reversed(subdirectories) \
+            if not scanned or subdirectory not in scanned)
+        yield ScannedDirectory(path=directory, subdirectories=subdirectories)
+
+def walk_directories_parallel(path=None, classifier=None, workers=None, index=None, scanned=None, preflight=None):
+    """
+    Scan path and its subdirectories using a pool of worker threads,
+    so listings of several directories are in progress at once.
+    At most two listings per worker are in progress or waiting for a worker,
+    other directories wait in a queue of paths. Subdirectories in scanned aren't scanned.
+    Workers pass matching files on in batches of SCAN_BATCH_SIZE through a bounded queue
+    as they list a directory, so large directories aren't held in memory.
+    Yields matching files as they are found and a ScannedDirectory as the listing of
+    each directory completes, a directory's ScannedDirectory is always yielded before
+    the files of its subdirectories.
+    """
+    directories = collections.deque([os.fspath(path)])
+    results = queue.Queue(maxsize=QUEUE_SIZE // SCAN_BATCH_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        # stop waiting for space in the queue if the consumer has gone away
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_directory(directory=None):
+        if stop.is_set():
+            return
+        subdirectories = []
+        batch = []
+        try:
+            for file_match in scan_directory(path=directory, classifier=classifier, index=index, \
+                preflight=preflight, subdirectories=subdirectories):
+                batch.append(file_match)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    if not put(batch):
+                        return
+                    batch = []
+        except BaseException as e:
+            put(StageError(error=e))
+            return
+        if batch and not put(batch):
+            return
+        put(ScannedDirectory(path=directory, subdirectories=subdirectories))
+
+    in_progress = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while directories or in_progress:
+                while directories and in_progress < workers * 2:
+                    executor.submit(list_directory, directory=directories.popleft())
+                    in_progress += 1
+                item = results.get()
+                if isinstance(item, StageError):
+                    raise item.error
+                if isinstance(item, ScannedDirectory):
+                    in_progress -= 1
+                    directories.extend(subdirectory for subdirectory in item.subdirectories \
+                        if not scanned or subdirectory not in scanned)
+                    yield item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+
+def scan_files(path=None, classifier=None, workers=1, index=None, report=True, scanned=None, markers=False, \
+    preflight=None):
+    """
+    Scan the directory once for files matching any of the file types of the classifier.
+    The first file type to match a file, in order of precedence, determines its
+    file type so no file is matched twice.
+    Directories are listed by a pool of worker threads if workers is more than 1,
+    the files found are the same but are found in a different order.
+    An optional ScanIndex avoids listing directories unchanged since the last run.
+    Subdirectories in scanned, directories already scanned by an earlier run, are skipped.
     Extract relevant parts from file for organization and sorting
-    Return a list of matching files
+    Yield each matching file as it is found, followed by a ScannedDirectory
+    for each directory if markers is True.
     """
-    matches = []
-    print('pattern:', pattern)
-    file_pattern = re.compile(pattern)
-    for root, dirs, files in os.walk(path):
+    match_count = 0
+    if workers > 1:
+        directory_matches = walk_directories_parallel(path=path, classifier=classifier, workers=workers, \
+            index=index, scanned=scanned, preflight=preflight)
+    else:
+        directory_matches = walk_directories(path=path, classifier=classifier, index=index, scanned=scanned, \
+            preflight=preflight)
+    for file_match in directory_matches:
+        if isinstance(file_match, ScannedDirectory):
+            if markers:
+                yield file_match
+            continue
+        match_count += 1
+        yield file_match
+    if report:
+        print('match count', match_count)
+        if index is not None:
+            print('directories listed', index.listed_count, 'reused from scan index', index.reused_count)
+
+class SortJournal():
+    """
+    Write-ahead journal of a sort run, kept next to the CSV log, used to resume
+    an interrupted run without scanning the input tree again.
+    Each line is a JSON list:
+    ["start", input_path, fingerprint] when the journal is created,
+    ["plan", directory, name, file_type] before a file is moved,
+    ["done", source] once the result of the move is logged,
+    ["scanned", directory, subdirectories] after the files of a directory are planned,
+    ["scan_complete"] after the whole input tree is scanned.
+    Lines are buffered and flushed at least every FLUSH_INTERVAL seconds. As lines are
+    written in order, a lost line means every later line was lost too: a directory whose
+    plans were lost is scanned again, a move whose done line was lost is found
+    to have no source left when resumed.
+    """
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path=None, input_path=None, fingerprint=None, resume=False):
+        self.path = path
+        self.input_path = os.fspath(input_path)
+        self.fingerprint = fingerprint
+        # source -> (directory, name, file_type) of planned moves
+        self.planned = {}
+        self.done = set()
+        # directory -> subdirectories of directories whose files are all planned
+        self.scanned = {}
+        self.scan_complete = False
+        if resume:
+            self.load()
+        self.file = open(path, 'a')
+        if not resume:
+            self.write(['start', self.input_path, fingerprint])
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line cut short when the run was interrupted
+                    continue
+                kind = record[0]
+                if kind == 'plan':
+                    directory, name, file_type = record[1:]
+                    self.planned[os.path.join(directory, name)] = (directory, name, file_type)
+                elif kind == 'done':
+                    self.done.add(record[1])
+                elif kind == 'scanned':
+                    self.scanned[record[1]] = record[2]
+                elif kind == 'scan_complete':
+                    self.scan_complete = True
+                elif kind == 'start':
+                    self.input_path, self.fingerprint = record[1:]
+
+    def write(self, record=None):
+        self.file.write(json.dumps(record) + '\n')
+
+    def record(self, record=None):
+        with self.lock:
+            self.write(record)
+            now = time.monotonic()
+            if now - self.flushed >= self.FLUSH_INTERVAL:
+                self.file.flush()
+                self.flushed = now
+
+    def record_plans(self, files=None):
+        """
+        Record each file before passing it on to be moved and each scanned directory.
+        Yields the files.
+        """
         for file in files:
-            #print(os.path.join(root, file))
-            m = file_pattern.match(file)
-            if m:
-                file_dict = m.groupdict()
-                file_path = os.path.join(root, file)
-                file_dict['file_path'] = file_path
-                file_dict['file_type'] = file_type
-                matches.append(file_dict)
-    print('match count', len(matches))
-    return matches
-
-def sort_files(files=None, folder_increment=None, number_pad=None, collection_prefix=None, output_path=None):
-    """
-    Sort and move files into correct directory based on
-    file pattern and directory name increments
+            if isinstance(file, ScannedDirectory):
+                self.record(['scanned', file.path, file.subdirectories])
+                continue
+            self.record(['plan', file.directory, file.name, file.file_type])
+            yield file
+        self.record(['scan_complete'])
+
+    def record_done(self, source=None):
+        self.record(['done', os.fspath(source)])
+
+    def pending_files(self, classifier=None):
+        """
+        Yield the planned files not yet moved, or None for each one whose source is gone.
+        """
+        for source, (directory, name, file_type) in self.planned.items():
+            if source in self.done:
+                continue
+            if not os.path.lexists(source):
+                self.record_done(source)
+                yield None
+                continue
+            file_match = classifier.classify(directory=directory, name=name)
+            if file_match is not None and file_match.file_type == file_type:
+                yield file_match
+
+    def unscanned_directories(self):
+        """
+        Return the directories left to scan, each to be scanned with its subdirectories.
+        """
+        if self.input_path not in self.scanned:
+            return [self.input_path]
+        return [subdirectory for subdirectories in self.scanned.values() \
+            for subdirectory in subdirectories if subdirectory not in self.scanned]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def resume_files(journal=None, classifier=None, workers=1, index=None):
     """
-    sorted_file_count = 0
-    unmoved_file_count = 0    
-    for file in files:
-        file_path = Path(file['file_path'])
-        file_type = file['file_type']
-        basename = file_path.name
-        #print(f'File {file_path} will be sorted to {output_path}')
-        numerical = int(file['numerical'])
+    Yield the files planned by an interrupted run and not moved, then the files of
+    the directories it didn't scan, followed by ScannedDirectory markers.
+    A directory interrupted partway through its plans is scanned again, its files
+    that were already planned are skipped so they aren't moved twice.
+    """
+    resumed_count = 0
+    completed_count = 0
+    for file in journal.pending_files(classifier=classifier):
+        if file is None:
+            completed_count += 1
+        else:
+            resumed_count += 1
+            yield file
+    print('resumed planned moves', resumed_count, 'already completed', completed_count)
+    if not journal.scan_complete:
+        directories = journal.unscanned_directories()
+        print('resumed directories to scan', len(directories))
+        for directory in directories:
+            for file in scan_files(path=directory, classifier=classifier, workers=workers, index=index, \
+                report=False, scanned=journal.scanned, markers=True):
+                if not isinstance(file, ScannedDirectory) and file.file_path in journal.planned:
+                    continue
+                yield file
+
+class StageError():
+    """
+    Wraps an exception raised by a pipeline stage running in a background thread
+    so it can be raised again in the thread consuming the stage.
+    """
+    def __init__(self, error=None):
+        self.error = error
+
+def buffered(iterable=None, maxsize=QUEUE_SIZE):
+    """
+    Run a pipeline stage in a background thread.
+    Items are passed on through a bounded queue so the stage runs ahead
+    of the next stage by at most maxsize items.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        # stop waiting for space in the queue if the consumer has gone away
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(StageError(error=e))
+        else:
+            put(finished)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is finished:
+                break
+            if isinstance(item, StageError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+class DestinationPlanner():
+    """
+    Determine the destination directory of each file based on
+    file type and directory name increments, and create each
+    destination directory once.
+    output_paths maps each file type to its output directory,
+    files of a type without an output directory are left in place.
+    A destination directory is created by a pool of threads when the
+    first file for it is planned, moves into it wait for it to exist.
+    Directories known to exist are cached for the rest of the run.
+    If shard is given as (index, count), only files whose destination folder number
+    is index modulo count are planned, so shards never share a destination directory.
+    """
+    def __init__(self, folder_increment=None, number_pad=None, collection_prefix=None, output_paths=None, \
+        create_directories=True, workers=DIRECTORY_WORKERS, shard=None):
+        self.folder_increment = folder_increment
+        self.shard = shard
+        self.number_pad = number_pad
+        self.collection_prefix = collection_prefix
+        self.output_paths = output_paths
+        self.create_directories = create_directories
+        # one Path per destination directory, shared by every file sorted into it
+        self.destination_directories = {}
+        # destination directory -> future of its creation
+        self.directories_created = {}
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def destination_directory(self, file_type=None, numerical=None):
+        """
+        Return the destination directory for a file, or None if the file type has no output directory.
+        """
+        output_path = self.output_paths.get(file_type, None)
+        if output_path is None or not self.in_shard(numerical):
+            return None
         # Determine what folder number the files should be moved to
-        folder_number = int(numerical//folder_increment*folder_increment)
-        padded_folder_number = str(folder_number).zfill(number_pad)
-        destination_folder_name = collection_prefix + padded_folder_number
-        destination_path = Path(output_path).joinpath(destination_folder_name)
-        #move_result = move_file(source=file_path, \
-        move_result = move_file(source=file_path, \
-            destination_directory=destination_path, \
-            filename=basename, \
-            filetype=file_type, \
-            force_overwrite=settings.force_overwrite
-            )
+        folder_number = int(numerical//self.folder_increment*self.folder_increment)
+        key = (output_path, folder_number)
+        destination_directory = self.destination_directories.get(key, None)
+        if destination_directory is None:
+            padded_folder_number = str(folder_number).zfill(self.number_pad)
+            destination_folder_name = self.collection_prefix + padded_folder_number
+            destination_directory = self.destination_directories[key] = output_path.joinpath(destination_folder_name)
+            if self.create_directories:
+                with self.lock:
+                    if destination_directory not in self.directories_created:
+                        self.directories_created[destination_directory] = self.executor.submit( \
+                            destination_directory.mkdir, parents=True, exist_ok=True)
+        return destination_directory
+
+    def in_shard(self, numerical=None):
+        """
+        Return whether a file with this catalog number is sorted by this shard.
+        """
+        if self.shard is None:
+            return True
+        index, count = self.shard
+        return numerical // self.folder_increment % count == index
+
+    def plan(self, files=None):
+        """
+        Set the destination directory of each file, yielding the files to be moved.
+        ScannedDirectory markers are passed on.
+        """
+        for file in files:
+            if isinstance(file, ScannedDirectory):
+                yield file
+                continue
+            destination_directory = self.destination_directory(file_type=file.file_type, numerical=file.numerical)
+            if destination_directory is None:
+                continue
+            file.destination_directory = destination_directory
+            yield file
+
+    def prepare(self, files=None):
+        """
+        Plan a batch of files and wait until all of their destination directories exist.
+        Returns the files to be moved.
+        """
+        files = list(self.plan(files=files))
+        for destination_directory in {file.destination_directory for file in files}:
+            self.ensure_directory(destination_directory)
+        return files
+
+    def ensure_directory(self, destination_directory=None):
+        """
+        Wait for a destination directory to be created, creating it if it wasn't planned.
+        """
+        if not self.create_directories:
+            return
+        future = self.directories_created.get(destination_directory, None)
+        if future is None:
+            with self.lock:
+                future = self.directories_created.get(destination_directory, None)
+                if future is None:
+                    future = self.directories_created[destination_directory] = self.executor.submit( \
+                        destination_directory.mkdir, parents=True, exist_ok=True)
+        #TODO Log creation of directory? If so, will need to force exception and only log when no exception
+        future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+class CollisionDetector():
+    """
+    Detect file name collisions in destination directories.
+    Each destination directory is listed once with os.scandir and its file names
+    kept in a set, updated as files are moved into it. Checking whether a
+    destination exists is then a set lookup, and two files of the same run
+    moved to the same destination are caught as well.
+    Files created in a destination directory by other processes after
+    it was listed aren't seen.
+    If a digest cache is given, files identical to the existing file they
+    collide with are found by is_duplicate, comparing sizes then digests.
+    """
+    def __init__(self, digests=None):
+        # destination directory -> set of names in it
+        self.names = {}
+        self.lock = threading.Lock()
+        self.listed_count = 0
+        self.digests = digests
+
+    def directory_names(self, destination_directory=None):
+        with self.lock:
+            names = self.names.get(destination_directory, None)
+            if names is None:
+                names = set()
+                try:
+                    with os.scandir(destination_directory) as entries:
+                        for entry in entries:
+                            names.add(entry.name)
+                except FileNotFoundError:
+                    pass
+                self.names[destination_directory] = names
+                self.listed_count += 1
+            return names
+
+    def exists(self, destination_directory=None, filename=None):
+        return filename in self.directory_names(destination_directory)
+
+    def add(self, destination_directory=None, filename=None):
+        names = self.directory_names(destination_directory)
+        with self.lock:
+            names.add(filename)
+
+    def is_duplicate(self, source=None, destination=None):
+        """
+        Return whether source has the same content as the existing destination file.
+        Always False without a digest cache.
+        """
+        if self.digests is None:
+            return False
+        try:
+            source_stat = os.stat(source)
+            destination_stat = os.stat(destination)
+        except OSError:
+            return False
+        if (source_stat.st_dev, source_stat.st_ino) == (destination_stat.st_dev, destination_stat.st_ino):
+            # the same file, not a copy of it
+            return False
+        if source_stat.st_size != destination_stat.st_size:
+            return False
+        # sources are hashed directly, they are moved or removed so only archive digests are cached
+        return hash_file(source) == self.digests.digest(path=destination, stat=destination_stat)
+
+def move_planned_file(file=None, planner=None, collisions=None, manifests=None):
+    """
+    Move a file into the destination directory planned for it.
+    """
+    #print(f'File {file.file_path} will be sorted to {file.destination_directory}')
+    move_result = move_file(source=file.file_path, \
+        destination_directory=file.destination_directory, \
+        filename=file.name, \
+        filetype=file.file_type, \
+        force_overwrite=settings.force_overwrite, \
+        planner=planner, \
+        collisions=collisions, \
+        manifests=manifests
+        )
+    move_result['log_row']['catalog_number'] = file.catalog_number
+    return move_result
+
+class Preflight():
+    """
+    Check what would fail if the files found were sorted, without moving files
+    or creating directories.
+    Writability of each source directory, destination directory and the nearest existing
+    parent of a destination directory not yet created is checked once and cached.
+    Source files are checked from the DirEntry of the scan: files on the same filesystem
+    as their output directory are renamed and need no further checks, files copied
+    to another filesystem are checked for read permission from their mode bits
+    and their size added to the bytes to copy to that filesystem.
+    Destination collisions are found with the collision detector, a file identical
+    to the existing file doesn't fail if the collision detector has a digest cache.
+    Each file that would fail is logged, and summarized by report.
+    """
+    EXAMPLE_COUNT = 5
+
+    def __init__(self, output_paths=None, unwritable_file_types=None, force_overwrite=False, planner=None):
+        self.planner = planner
+        self.unwritable_file_types = set(unwritable_file_types or [])
+        self.force_overwrite = force_overwrite
+        # file type -> device of its output directory, and device -> an output directory on it
+        self.output_devices = {}
+        self.device_paths = {}
+        for file_type, output_path in output_paths.items():
+            device = os.stat(output_path).st_dev
+            self.output_devices[file_type] = device
+            self.device_paths.setdefault(device, output_path)
+        # directory -> writable, and source directory -> device
+        self.writable = {}
+        self.directory_devices = {}
+        self.uid = os.geteuid()
+        self.groups = set(os.getgroups()) | {os.getegid()}
+        self.copy_bytes = collections.Counter()
+        self.copy_count = 0
+        # files checked by check, files of those that would fail, and files that would fail at all
+        self.checked_count = 0
+        self.checked_failed_count = 0
+        self.failed_count = 0
+        self.failures = collections.Counter()
+        self.examples = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def is_writable(self, directory=None):
+        """
+        Return whether files can be created in directory, or in the nearest
+        existing parent directory if it doesn't exist.
+        """
+        writable = self.writable.get(directory, None)
+        if writable is None:
+            if os.path.isdir(directory):
+                writable = os.access(directory, os.W_OK | os.X_OK)
+            else:
+                parent = os.path.dirname(directory)
+                writable = parent != directory and self.is_writable(parent)
+            self.writable[directory] = writable
+        return writable
+
+    def is_readable(self, stat=None):
+        if self.uid == 0:
+            return True
+        if stat.st_uid == self.uid:
+            return bool(stat.st_mode & 0o400)
+        if stat.st_gid in self.groups:
+            return bool(stat.st_mode & 0o040)
+        return bool(stat.st_mode & 0o004)
+
+    def fail(self, reason=None, source=None, file_type=None, destination=None):
+        with self.lock:
+            self.failures[reason] += 1
+            if len(self.examples[reason]) < self.EXAMPLE_COUNT:
+                self.examples[reason].append(source)
+            self.failed_count += 1
+        writer.writerow({'timestamp': time.time(), 'username': username, 'action': 'preflight', 'result': 'fail', \
+            'details': reason, 'filetype': file_type, 'source': source, 'destination': destination})
+
+    def check_source(self, entry=None, file_match=None):
+        """
+        Check a file found by the scan, called from the scanning threads.
+        Returns False if the file would fail, so it isn't passed on to check.
+        """
+        file_type = file_match.file_type
+        if not self.planner.in_shard(file_match.numerical):
+            return True
+        if file_type in self.unwritable_file_types:
+            self.fail(reason='output directory not writable', source=entry.path, file_type=file_type)
+            return False
+        output_device = self.output_devices.get(file_type, None)
+        if output_device is None:
+            return True
+        directory = file_match.directory
+        if not self.is_writable(directory):
+            self.fail(reason='source directory not writable', source=entry.path, file_type=file_type)
+            return False
+        device = self.directory_devices.get(directory, None)
+        if device is None:
+            device = self.directory_devices[directory] = os.stat(directory).st_dev
+        if device != output_device:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                self.fail(reason='source not found', source=entry.path, file_type=file_type)
+                return False
+            if not self.is_readable(stat):
+                self.fail(reason='source not readable', source=entry.path, file_type=file_type)
+                return False
+            with self.lock:
+                self.copy_bytes[output_device] += stat.st_size
+                self.copy_count += 1
+        return True
+
+    def check(self, files=None, collisions=None):
+        """
+        Check the destination of each planned file.
+        Files that failed check_source aren't passed on by the scan, they are
+        counted as unmoved along with the files that fail here.
+        """
+        for file in files:
+            self.checked_count += 1
+            source = file.file_path
+            destination_directory = os.fspath(file.destination_directory)
+            destination = os.path.join(destination_directory, file.name)
+            if not self.is_writable(destination_directory):
+                self.checked_failed_count += 1
+                self.fail(reason='destination directory not writable', source=source, \
+                    file_type=file.file_type, destination=destination)
+            elif collisions.exists(file.destination_directory, file.name) and not self.force_overwrite \
+                and not collisions.is_duplicate(source=source, destination=destination):
+                self.checked_failed_count += 1
+                self.fail(reason='filename exists', source=source, file_type=file.file_type, destination=destination)
+            else:
+                collisions.add(file.destination_directory, file.name)
+        return {
+            'sorted_file_count': self.checked_count - self.checked_failed_count, \
+            'unmoved_file_count': self.failed_count, \
+            }
+
+    def report(self):
+        print('PREFLIGHT')
+        print('files checked', self.checked_count + self.failed_count - self.checked_failed_count, \
+            'would fail', self.failed_count)
+        for reason, count in self.failures.most_common():
+            print(f'{count} would fail: {reason}, e.g.')
+            for example in self.examples[reason]:
+                print('   ', example)
+        print('files to copy to other filesystems', self.copy_count)
+        for device, copy_bytes in self.copy_bytes.items():
+            output_path = self.device_paths[device]
+            statvfs = os.statvfs(output_path)
+            free_bytes = statvfs.f_bavail * statvfs.f_frsize
+            print(f'bytes to copy to {output_path}: {copy_bytes} free: {free_bytes}')
+            if copy_bytes > free_bytes:
+                print('WARNING - not enough space on filesystem of', output_path)
+
+def sort_files(files=None, planner=None, collisions=None, workers=1, manifests=None):
+    """
+    Sort and move files into the destination directory planned for each file.
+    If workers is more than 1 files are moved by a pool of worker threads.
+    Yield the result of each move
+    """
+    if workers > 1:
+        yield from sort_files_concurrently(files=files, planner=planner, collisions=collisions, workers=workers, \
+            manifests=manifests)
+        return
+    for file in files:
+        yield move_planned_file(file=file, planner=planner, collisions=collisions, manifests=manifests)
+
+def sort_files_concurrently(files=None, planner=None, collisions=None, workers=None, manifests=None):
+    """
+    Move files on a pool of worker threads so several moves are in progress at once.
+    At most two moves per worker are in progress or waiting for a worker.
+    Moves to the same destination are never in progress at the same time,
+    a move waits for an earlier move to the same destination to finish.
+    Yield the result of each move as it completes, so results are
+    logged and counted by the thread consuming them.
+    """
+    # future -> destination and destination -> future of the moves in progress
+    in_progress = {}
+    destinations = {}
+
+    def finished(done):
+        for future in done:
+            destination = in_progress.pop(future)
+            if destinations.get(destination, None) is future:
+                del destinations[destination]
+            yield future.result()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for file in files:
+            destination = os.path.join(file.destination_directory, file.name)
+            earlier = destinations.get(destination, None)
+            if earlier is not None:
+                concurrent.futures.wait([earlier])
+                yield from finished([earlier])
+            while len(in_progress) >= workers * 2:
+                done, not_done = concurrent.futures.wait(in_progress, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from finished(done)
+            future = executor.submit(move_planned_file, file=file, planner=planner, collisions=collisions, \
+                manifests=manifests)
+            in_progress[future] = destination
+            destinations[destination] = future
+        while in_progress:
+            done, not_done = concurrent.futures.wait(in_progress, return_when=concurrent.futures.FIRST_COMPLETED)
+            yield from finished(done)
+
+class LogWriter():
+    """
+    Write log rows to a CSV file from a background thread, so moves don't wait on the log file.
+    Rows are queued by writerow and written in batches, the file is flushed once
+    batch_size rows are waiting or flush_interval seconds after the last flush.
+    Timestamps given as time.time() values are formatted as datetime.now() would have.
+    The log is gzip compressed if compress is True.
+    If a database path is given each batch of rows is also inserted into the
+    moves table of that SQLite database in one transaction, with the run_id of the run.
+    Remaining rows are written and the file closed by close, which is also
+    called at exit if it wasn't called before.
+    """
+    def __init__(self, path=None, fieldnames=None, compress=False, batch_size=LOG_BATCH_SIZE, \
+        flush_interval=LOG_FLUSH_INTERVAL, database=None, run_id=None):
+        if compress:
+            self.file = gzip.open(path, 'wt', newline='')
+        else:
+            self.file = open(path, 'w', newline='')
+        # rows may carry fields only kept in the database
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        self.writer.writeheader()
+        self.database = database
+        self.run_id = run_id
+        self.connection = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = queue.Queue(maxsize=batch_size * 10)
+        self.flush_requested = object()
+        self.close_requested = object()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def writerow(self, row=None):
+        if self.error is not None:
+            raise self.error
+        self.rows.put(row)
+
+    def flush(self):
+        """
+        Ask for the rows queued so far to be written and flushed without waiting for them.
+        """
+        self.rows.put(self.flush_requested)
+
+    def run(self):
+        if self.database is not None:
+            try:
+                self.connect()
+            except BaseException as e:
+                self.error = e
+        batch = []
+        flushed = time.monotonic()
+        while True:
+            timeout = max(0, self.flush_interval - (time.monotonic() - flushed))
+            try:
+                row = self.rows.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+            closing = row is self.close_requested
+            if row is not None and row is not self.flush_requested and not closing:
+                batch.append(row)
+            if closing or row is self.flush_requested or len(batch) >= self.batch_size \
+                or time.monotonic() - flushed >= self.flush_interval:
+                try:
+                    self.write(batch)
+                except BaseException as e:
+                    self.error = e
+                batch = []
+                flushed = time.monotonic()
+            if closing:
+                if self.connection is not None:
+                    self.connection.close()
+                return
+
+    def connect(self):
+        # the connection is only used by the writer thread
+        self.connection = sqlite3.connect(self.database, timeout=60)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS moves (' \
+                + ', '.join(LOG_DATABASE_COLUMNS) + ')')
+            for column in LOG_DATABASE_INDEXES:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS moves_{column} ON moves ({column})')
+        self.insert = 'INSERT INTO moves (' + ', '.join(LOG_DATABASE_COLUMNS) + ') VALUES (' \
+            + ', '.join('?' for column in LOG_DATABASE_COLUMNS) + ')'
+
+    def write(self, batch=None):
+        for row in batch:
+            timestamp = row.get('timestamp', None)
+            if isinstance(timestamp, float):
+                row['timestamp'] = datetime.datetime.fromtimestamp(timestamp)
+        self.writer.writerows(batch)
+        self.file.flush()
+        if self.connection is not None and batch:
+            with self.connection:
+                self.connection.executemany(self.insert, \
+                    [[self.run_id if column == 'run_id' else row.get(column, None) for column in LOG_DATABASE_COLUMNS] \
+                    for row in batch])
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.rows.put(self.close_requested)
+        self.thread.join()
+        self.file.close()
+        atexit.unregister(self.close)
+        if self.error is not None:
+            raise self.error
+
+def log_moves(move_results=None, journal=None):
+    """
+    Write the log row of each move and count the files moved and not moved.
+    Each move is recorded as done in the journal if there is one.
+    """
+    sorted_file_count = 0
+    unmoved_file_count = 0
+    for move_result in move_results:
+        writer.writerow(move_result['log_row'])
+        if journal is not None:
+            journal.record_done(source=move_result['log_row']['source'])
         if move_result['move_success']:
             sorted_file_count +=1
         else:
@@ -72,65 +1243,748 @@ def sort_files(files=None, folder_increment=None, number_pad=None, collection_pr
         'unmoved_file_count': unmoved_file_count, \
         }
 
-def move_file(source=None, destination_directory=None, filename=None, filetype=None, force_overwrite=False):
+PLAN_FIELDNAMES = ['source', 'destination', 'file_type', 'collision', 'catalog_number']
+
+def write_plan(files=None, plan_path=None, collisions=None):
+    """
+    Write the source, destination, file type, expected collision state and catalog
+    number of each planned file to a gzip compressed, tab delimited plan file,
+    without moving files.
+    Collision states are 'new', 'exists' for files already in the destination directory
+    and 'duplicate' for files with the same destination as an earlier file of the plan.
+    Destination directories are listed once by the collision detector.
+    Returns the number of files planned in each collision state.
+    """
+    collision_counts = collections.Counter()
+    planned = set()
+    with gzip.open(plan_path, 'wt', newline='') as f:
+        plan_writer = csv.writer(f, delimiter='\t')
+        plan_writer.writerow(PLAN_FIELDNAMES)
+        for file in files:
+            destination = os.path.join(file.destination_directory, file.name)
+            if destination in planned:
+                collision = 'duplicate'
+            elif collisions.exists(file.destination_directory, file.name):
+                collision = 'exists'
+            else:
+                collision = 'new'
+                collisions.add(file.destination_directory, file.name)
+            planned.add(destination)
+            collision_counts[collision] += 1
+            plan_writer.writerow([file.file_path, destination, file.file_type, collision, file.catalog_number])
+    return collision_counts
+
+def read_plan(plan_path=None):
+    """
+    Yield the files of a plan file with their destination directory set.
+    Plan files written before the catalog number was added give files without one.
+    Files whose source no longer exists, such as files moved by an earlier
+    execution of the plan, are skipped.
+    """
+    missing_count = 0
+    destination_directories = {}
+    with gzip.open(plan_path, 'rt', newline='') as f:
+        plan_reader = csv.DictReader(f, delimiter='\t')
+        for row in plan_reader:
+            source = row['source']
+            if not os.path.lexists(source):
+                missing_count += 1
+                continue
+            directory, name = os.path.split(source)
+            destination_directory = os.path.dirname(row['destination'])
+            file = FileMatch(directory=directory, name=name, file_type=row['file_type'], \
+                catalog_number=row.get('catalog_number', None))
+            # one Path per destination directory, as planned by DestinationPlanner
+            file.destination_directory = destination_directories.get(destination_directory, None)
+            if file.destination_directory is None:
+                file.destination_directory = destination_directories[destination_directory] = \
+                    Path(destination_directory)
+            yield file
+    print('planned files no longer found', missing_count)
+
+def execute_plan(plan_path=None, move_workers=1, manifest_file_types=None, digest_cache_path=None):
+    """
+    Move the files of a plan file written with --plan, without scanning or classifying files.
+    Collisions are checked again when files are moved.
+    """
+    global sorted_file_count
+    global unmoved_file_count
+    planner = DestinationPlanner(output_paths={}, create_directories=not dry_run)
+    digests = DigestCache(path=digest_cache_path) if digest_cache_path else None
+    collisions = CollisionDetector(digests=digests)
+    manifests = ChecksumManifests(file_types=manifest_file_types)
+    try:
+        move_results = buffered(sort_files(files=buffered(read_plan(plan_path=plan_path)), planner=planner, \
+            collisions=collisions, workers=move_workers, manifests=manifests))
+        sort_result = log_moves(move_results=move_results)
+    finally:
+        planner.close()
+        manifests.close()
+        if digests is not None:
+            digests.close()
+    sorted_file_count += sort_result.get('sorted_file_count', 0)
+    unmoved_file_count += sort_result.get('unmoved_file_count', 0)
+
+class TokenBucket():
+    """
+    Token bucket allowing rate units per second on average, in bursts of up to one second's worth.
+    Tokens may be taken before they are available, the debt is paid by waiting.
+    A rate of None or 0 is unlimited.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate=None):
+        self.rate = rate
+        self.tokens = min(self.tokens, rate or 0)
+
+    def reserve(self, amount=None):
+        """
+        Take amount tokens, returning the seconds to wait before using them.
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+class RateLimiter():
+    """
+    Limit the moves per second and bytes copied per second of the move stage, shared by all move workers.
+    Limits can be changed while running through a JSON control file with optional
+    "ops_per_second" and "bytes_per_second" keys. The file is read at start, when
+    it is modified, and when the process receives SIGHUP.
+    The time spent waiting for each limit is kept to report how much moves were throttled.
+    """
+    CONTROL_CHECK_INTERVAL = 1.0
+
+    def __init__(self, ops_per_second=None, bytes_per_second=None, control_path=None):
+        self.ops = TokenBucket(rate=ops_per_second)
+        self.bytes = TokenBucket(rate=bytes_per_second)
+        self.control_path = control_path
+        self.control_mtime_ns = None
+        self.control_checked = 0
+        self.reload_requested = False
+        self.lock = threading.Lock()
+        self.throttled = {'ops': 0.0, 'bytes': 0.0}
+        if control_path:
+            self.check_control()
+
+    def request_reload(self, signum=None, frame=None):
+        """
+        Signal handler asking for the control file to be read before the next move.
+        """
+        self.reload_requested = True
+
+    def check_control(self):
+        if not self.control_path:
+            return
+        now = time.monotonic()
+        if not self.reload_requested and now - self.control_checked < self.CONTROL_CHECK_INTERVAL:
+            return
+        self.control_checked = now
+        try:
+            mtime_ns = os.stat(self.control_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns == self.control_mtime_ns and not self.reload_requested:
+            return
+        self.reload_requested = False
+        self.control_mtime_ns = mtime_ns
+        try:
+            with open(self.control_path) as f:
+                limits = json.load(f)
+        except (OSError, ValueError) as e:
+            print('WARNING - unable to read rate control file:', self.control_path, e)
+            return
+        self.ops.set_rate(limits.get('ops_per_second', self.ops.rate))
+        self.bytes.set_rate(limits.get('bytes_per_second', self.bytes.rate))
+        print('rate limits: ops/s', self.ops.rate, 'bytes/s', self.bytes.rate)
+
+    def acquire(self, name=None, amount=1):
+        with self.lock:
+            self.check_control()
+            wait = getattr(self, name).reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+            with self.lock:
+                self.throttled[name] += wait
+
+    def acquire_op(self):
+        self.acquire(name='ops', amount=1)
+
+    def acquire_bytes(self, amount=None):
+        self.acquire(name='bytes', amount=amount)
+
+    def chunk_size(self, size=None):
+        """
+        Limit copy chunks to one second's worth of bytes, so copies are throttled evenly.
+        """
+        if self.bytes.rate:
+            return max(HASH_CHUNK_SIZE, min(size, int(self.bytes.rate)))
+        return size
+
+    def report(self):
+        # summed over move workers waiting at the same time
+        print('seconds throttled: ops', round(self.throttled['ops'], 1), 'bytes', round(self.throttled['bytes'], 1), \
+            'limits: ops/s', self.ops.rate, 'bytes/s', self.bytes.rate)
+
+def copy_file_contents(source_file=None, destination_file=None):
+    """
+    Copy the contents of an open source file to an open destination file.
+    The copy is done in the kernel with os.copy_file_range, or os.sendfile where
+    copy_file_range isn't supported, falling back to copying in Python.
+    Bytes copied count against the rate limiter if there is one.
+    Returns the copy method used and the number of bytes copied.
+    """
+    source_fd = source_file.fileno()
+    destination_fd = destination_file.fileno()
+    copied = 0
+    chunk_size = COPY_CHUNK_SIZE if rate_limiter is None else rate_limiter.chunk_size(COPY_CHUNK_SIZE)
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while True:
+                if method == 'copy_file_range':
+                    count = os.copy_file_range(source_fd, destination_fd, chunk_size)
+                else:
+                    count = os.sendfile(destination_fd, source_fd, copied, chunk_size)
+                if count == 0:
+                    return method, copied
+                copied += count
+                if rate_limiter is not None:
+                    rate_limiter.acquire_bytes(count)
+        except OSError as e:
+            # only fall back if nothing was copied yet, the file offsets are then still at the start
+            if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    shutil.copyfileobj(source_file, destination_file, chunk_size)
+    copied = destination_file.tell()
+    if rate_limiter is not None:
+        rate_limiter.acquire_bytes(copied)
+    return 'copy', copied
+
+class ChecksumError(Exception):
+    """
+    Raised when a copied file doesn't match the digest of its source.
+    """
+    pass
+
+def hash_file(path=None):
+    """
+    Return the sha256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def copy_and_hash(source_file=None, destination_file=None):
+    """
+    Copy the contents of an open source file to an open destination file in Python,
+    hashing the data as it is copied.
+    Returns the number of bytes copied and the sha256 hex digest.
+    """
+    digest = hashlib.sha256()
+    copied = 0
+    with memoryview(bytearray(HASH_CHUNK_SIZE)) as buffer:
+        while True:
+            count = source_file.readinto(buffer)
+            if not count:
+                break
+            digest.update(buffer[:count])
+            destination_file.write(buffer[:count])
+            copied += count
+            if rate_limiter is not None:
+                rate_limiter.acquire_bytes(count)
+    return copied, digest.hexdigest()
+
+def verify_copy(destination_file=None, expected_digest=None):
+    """
+    Check a copied file against the digest computed while copying it.
+    The copy is flushed to disk and dropped from the page cache first,
+    so the data is read back from disk rather than from memory.
+    """
+    destination_file.flush()
+    fd = destination_file.fileno()
+    os.fsync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    if hash_file(destination_file.name) != expected_digest:
+        raise ChecksumError(f'{destination_file.name} does not match digest {expected_digest}')
+
+def transfer_file(source=None, destination=None, checksum=False, verify=False):
+    """
+    Move a file from source to destination.
+    On the same filesystem the file is renamed. Across filesystems the file is copied
+    to a temporary name next to the destination, its metadata copied, then renamed
+    into place and the source removed.
+    If checksum is True the sha256 digest of the file is computed, while copying
+    or by reading a renamed file once.
+    If verify is True copies are hashed while copying and read back from disk
+    to check them before the source is removed, a mismatch raises ChecksumError
+    and leaves the source in place.
+    Returns the method used, the number of bytes copied and the digest or None.
+    """
+    digest = None
+    if os.path.islink(source):
+        shutil.move(source, destination)
+        return 'symlink', 0, digest
+    try:
+        os.rename(source, destination)
+        if checksum:
+            digest = hash_file(destination)
+        return 'rename', 0, digest
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    destination_directory, filename = os.path.split(destination)
+    partial = os.path.join(destination_directory, f'.{filename}.partial')
+    try:
+        with open(source, 'rb') as source_file, open(partial, 'wb') as destination_file:
+            if checksum or verify:
+                # kernel copies don't pass the data through Python, so it is copied here to hash it
+                method = 'copy'
+                copied, digest = copy_and_hash(source_file=source_file, destination_file=destination_file)
+                if verify:
+                    verify_copy(destination_file=destination_file, expected_digest=digest)
+            else:
+                method, copied = copy_file_contents(source_file=source_file, destination_file=destination_file)
+        shutil.copystat(source, partial)
+        os.replace(partial, destination)
+    except BaseException:
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+        raise
+    os.unlink(source)
+    return method, copied, digest
+
+class ChecksumManifests():
+    """
+    Append the digest of each file moved into a destination directory to a
+    manifest in that directory, in the format read by sha256sum --check.
+    Only files of the given file types are added.
+    Manifests of the most recently used directories are kept open, files are
+    sorted a directory at a time so older ones are closed as the run moves on.
+    """
+    MAX_OPEN_MANIFESTS = 16
+
+    def __init__(self, file_types=None):
+        self.file_types = set(file_types or [])
+        # destination directory -> open manifest file, least recently used first
+        self.manifests = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, destination_directory=None, filename=None, digest=None, replace=False):
+        """
+        Add a file's digest to its directory's manifest, if replace = True
+        any existing entry for the file name is removed first.
+        """
+        with self.lock:
+            if replace:
+                self.remove(destination_directory=destination_directory, filename=filename)
+            manifest = self.manifests.get(destination_directory, None)
+            if manifest is None:
+                if len(self.manifests) >= self.MAX_OPEN_MANIFESTS:
+                    directory, oldest_manifest = self.manifests.popitem(last=False)
+                    oldest_manifest.close()
+                manifest = open(os.path.join(destination_directory, MANIFEST_FILENAME), 'a')
+                self.manifests[destination_directory] = manifest
+            else:
+                self.manifests.move_to_end(destination_directory)
+            manifest.write(f'{digest}  {filename}\n')
+            manifest.flush()
+
+    def remove(self, destination_directory=None, filename=None):
+        """
+        Rewrite a directory's manifest without the entries for a file name,
+        called with the lock held.
+        """
+        manifest = self.manifests.pop(destination_directory, None)
+        if manifest is not None:
+            manifest.close()
+        manifest_path = os.path.join(destination_directory, MANIFEST_FILENAME)
+        try:
+            with open(manifest_path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        kept_lines = [line for line in lines if line.rstrip('\n').partition('  ')[2] != filename]
+        if len(kept_lines) == len(lines):
+            return
+        temporary_path = manifest_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            f.writelines(kept_lines)
+        os.replace(temporary_path, manifest_path)
+
+    def close(self):
+        with self.lock:
+            for manifest in self.manifests.values():
+                manifest.close()
+            self.manifests.clear()
+
+def move_file(source=None, destination_directory=None, filename=None, filetype=None, force_overwrite=False, \
+    planner=None, collisions=None, manifests=None):
     """
     Move files from the source to the destination directory.
-    Creates destination directory if it does not exist.
-    Will overwrite existing files if force_overwrite_confirmed = True.
+    Creates destination directory if it does not exist, using the planner's
+    cache of created directories if there is one.
+    Existing files are found with the collision detector if there is one.
+    Will overwrite existing files if force_overwrite_confirmed = True,
+    otherwise a file identical to the existing file is removed if the
+    collision detector has a digest cache.
+    Files are renamed where possible, see transfer_file.
+    Copies are checked against their digest if verify = True, and digests are
+    added to the checksum manifests for file types that have one.
+    Each move waits for the rate limiter if there is one.
+    Returns the result of the move and the row to be logged.
     """
-    destination = destination_directory.joinpath(filename)
+    destination = os.path.join(destination_directory, filename)
+    if collisions is not None:
+        destination_exists = collisions.exists(destination_directory, filename)
+    else:
+        destination_exists = os.path.exists(destination)
+    duplicate = destination_exists and not force_overwrite and collisions is not None \
+        and collisions.is_duplicate(source=source, destination=destination)
     if dry_run:
-        if destination.exists():
-            now = datetime.datetime.now()
+        if duplicate:
+            now = time.time()
+            move_success = True
+            status = 'DRY-RUN - simulated move'
+            log_row = {'timestamp': now, 'username': username, 'action': 'DRY_RUN-move', 'result': 'success', \
+                'details': 'identical file exists', 'filetype': filetype, 'source': source, 'destination': destination}
+        elif destination_exists:
+            now = time.time()
             move_success = False
             status = 'DRY-RUN - simulated move'
-            writer.writerow({'timestamp': now, 'username': username, 'action': 'DRY_RUN-move', 'result': 'fail', \
-                'filetype': filetype, 'source': source, 'destination': destination})
+            log_row = {'timestamp': now, 'username': username, 'action': 'DRY_RUN-move', 'result': 'fail', \
+                'filetype': filetype, 'source': source, 'destination': destination}
         else:
             print('DRY-RUN: Moved:', destination)
             status = 'DRY-RUN - simulated move'
             move_success = True
-            now = datetime.datetime.now()
-            writer.writerow({'timestamp': now, 'username': username, 'action': 'DRY_RUN-move', 'result': 'success', \
-                'filetype': filetype, 'source': source, 'destination': destination})
+            if collisions is not None:
+                collisions.add(destination_directory, filename)
+            now = time.time()
+            log_row = {'timestamp': now, 'username': username, 'action': 'DRY_RUN-move', 'result': 'success', \
+                'filetype': filetype, 'source': source, 'destination': destination}
     else:
+        if rate_limiter is not None:
+            rate_limiter.acquire_op()
         # Create directory path if it doesn't exist
-        destination_directory.mkdir(parents=True, exist_ok=True)
-        #TODO Log creation of directory? If so, will need to force exception and only log when no exception
-        if destination.exists() and force_overwrite == False:
+        if planner is not None:
+            planner.ensure_directory(destination_directory)
+        else:
+            destination_directory.mkdir(parents=True, exist_ok=True)
+        if duplicate:
+            try:
+                os.unlink(source)
+                status = 'success'
+                details = 'identical file exists - source removed'
+                move_success = True
+                move_method = 'duplicate'
+            except PermissionError:
+                status = 'fail'
+                details = 'identical file exists - PermissionError'
+                move_success = False
+                move_method = None
+            except OSError as e:
+                status = 'fail'
+                details = 'identical file exists - ' + str(e.strerror)
+                move_success = False
+                move_method = None
+            if verbose:
+                print('Identical file exists:', destination, status)
+            now = time.time()
+            log_row = {'timestamp': now, 'username': username, 'action': 'move', 'result': status, 'details': details, \
+                'filetype': filetype, 'source': source, 'destination': destination, 'move_method': move_method}
+        elif destination_exists and force_overwrite == False:
             if verbose:
                 print('Filename exists, cannot move:', destination)
             #TODO change to exception
             move_success = False
             status = 'fail'
             details = 'filename exists'
-            now = datetime.datetime.now()
-            writer.writerow({'timestamp': now, 'username': username, 'action': 'move', 'result': status, 'details': details,\
-                'filetype': filetype, 'source': source, 'destination': destination})
+            now = time.time()
+            log_row = {'timestamp': now, 'username': username, 'action': 'move', 'result': status, 'details': details,\
+                'filetype': filetype, 'source': source, 'destination': destination}
         else:
             try:
-                if destination.exists():
+                if destination_exists:
                     details = 'duplicate file name - overwritten'
                     if verbose:
                         print('Overwritting:', destination)  
                 else:
                     details = None
-                shutil.move(source, destination)
+                use_manifest = manifests is not None and filetype in manifests.file_types
+                move_method, bytes_copied, digest = transfer_file(source=source, destination=destination, \
+                    checksum=use_manifest, verify=verify)
                 status = 'success'
                 move_success = True
+                if collisions is not None:
+                    collisions.add(destination_directory, filename)
+                if use_manifest:
+                    manifests.add(destination_directory, filename, digest, replace=destination_exists)
             except PermissionError:
                 status = 'fail'
                 details = 'PermissionError'
                 move_success = False
-            now = datetime.datetime.now()
-            writer.writerow({'timestamp': now, 'username': username, \
+                move_method = None
+                bytes_copied = None
+                digest = None
+            except ChecksumError:
+                if verbose:
+                    print('Checksum mismatch, source kept:', source)
+                status = 'fail'
+                details = 'checksum mismatch'
+                move_success = False
+                move_method = None
+                bytes_copied = None
+                digest = None
+            except OSError as e:
+                # e.g. the source was removed after it was scanned, or the destination filesystem is full
+                if verbose:
+                    print('Move failed:', source, e.strerror)
+                status = 'fail'
+                details = str(e.strerror)
+                move_success = False
+                move_method = None
+                bytes_copied = None
+                digest = None
+            now = time.time()
+            log_row = {'timestamp': now, 'username': username, \
                 'action': 'move', 'result': status, 'details': details, \
-                'filetype': filetype, 'source': source, 'destination': destination})
+                'filetype': filetype, 'source': source, 'destination': destination, \
+                'move_method': move_method, 'bytes_copied': bytes_copied, 'sha256': digest}
             if verbose:
                 print('Move:', destination, status)    
-    return {'move_success': move_success, 'status': status}
+    return {'move_success': move_success, 'status': status, 'log_row': log_row}
+
+class InotifyWatcher():
+    """
+    Watch a directory tree for new files using Linux inotify through ctypes.
+    Every directory in the tree is watched, directories created later are added
+    as they appear. Raises OSError if inotify isn't available.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, path=None):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.watches = {}
+        try:
+            self.add_tree(path=path)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path=None):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        self.watches[wd] = path
+
+    def add_tree(self, path=None):
+        self.add_watch(path=path)
+        for root, dirs, files in os.walk(path):
+            for directory in dirs:
+                self.add_watch(path=os.path.join(root, directory))
+
+    def read(self, timeout=None):
+        """
+        Wait up to timeout seconds for events.
+        Returns (files, directories, overflow) with paths of files written or moved in,
+        paths of new directories, and whether events were lost and a full scan is needed.
+        """
+        files = []
+        directories = []
+        overflow = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return files, directories, overflow
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return files, directories, overflow
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd, None)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self.add_tree(path=path)
+                    except OSError:
+                        overflow = True
+                    directories.append(path)
+            else:
+                files.append(path)
+        return files, directories, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+def watch_files(input_path=None, classifier=None, index=None, scan_workers=1, settle_time=None, planner=None, \
+    collisions=None, move_workers=1, manifests=None):
+    """
+    Sort files as they arrive in input_path until interrupted.
+    New files are found with inotify where available, otherwise input_path is
+    scanned every settle_time seconds using the scan index so unchanged
+    directories aren't listed again.
+    A file is only moved once its size and modification time haven't changed
+    for settle_time seconds, so files still being written are left alone.
+    Files a batch leaves in place, such as collisions, aren't tried again
+    until their size or modification time changes.
+    Files ready to move are sorted in batches and logged as in a normal run.
+    """
+    sorted_file_count = 0
+    unmoved_file_count = 0
+    # file_path -> (size, mtime_ns, time first seen with that size, file)
+    pending = {}
+    # file_path -> (size, mtime_ns) of files left in place after being tried,
+    # skipped until they change so a failed move isn't retried every scan
+    tried = {}
+    try:
+        watcher = InotifyWatcher(path=input_path)
+        print('Watching for new files with inotify:', input_path)
+    except OSError as e:
+        watcher = None
+        print(f'inotify not available ({e}), scanning every {settle_time} seconds:', input_path)
+        if index is None:
+            index = ScanIndex(path=':memory:', fingerprint=classifier_fingerprint(classifier=classifier))
 
-# TODO Make dry run more useful - make it test destination perms and perms for each file to be moved
+    def add_pending(files):
+        for file in files:
+            file_path = file.file_path
+            if file_path in pending:
+                continue
+            if file_path in tried:
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    del tried[file_path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) == tried[file_path]:
+                    continue
+                del tried[file_path]
+            pending[file_path] = (None, None, None, file)
+
+    def scan(path):
+        if index is not None:
+            index.started_ns = time.time_ns()
+        add_pending(scan_files(path=path, classifier=classifier, workers=scan_workers, index=index, report=False))
+
+    try:
+        scan(input_path)
+        next_scan = time.monotonic() + settle_time
+        while True:
+            if watcher is not None:
+                files, directories, overflow = watcher.read(timeout=settle_time / 2)
+                if overflow:
+                    scan(input_path)
+                for directory in directories:
+                    scan(directory)
+                add_pending(file for file in (classifier.classify(directory=os.path.dirname(file_path), \
+                    name=os.path.basename(file_path)) for file_path in files) if file)
+            else:
+                time.sleep(max(0, min(next_scan - time.monotonic(), settle_time / 2)))
+                if time.monotonic() >= next_scan:
+                    scan(input_path)
+                    next_scan = time.monotonic() + settle_time
+            # Check which files have stopped changing
+            now = time.monotonic()
+            ready = []
+            for file_path, (size, mtime_ns, since, file) in list(pending.items()):
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    del pending[file_path]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                    pending[file_path] = (stat.st_size, stat.st_mtime_ns, now, file)
+                elif now - since >= settle_time:
+                    del pending[file_path]
+                    ready.append(file)
+            for start in range(0, len(ready), WATCH_BATCH_SIZE):
+                batch = ready[start:start + WATCH_BATCH_SIZE]
+                planned_files = planner.prepare(files=batch)
+                batch_result = log_moves(move_results=sort_files(files=planned_files, planner=planner, \
+                    collisions=collisions, workers=move_workers, manifests=manifests))
+                writer.flush()
+                for file in batch:
+                    try:
+                        stat = os.stat(file.file_path)
+                    except OSError:
+                        continue
+                    tried[file.file_path] = (stat.st_size, stat.st_mtime_ns)
+                sorted_file_count += batch_result['sorted_file_count']
+                unmoved_file_count += batch_result['unmoved_file_count']
+                if verbose:
+                    print('Batch sorted:', batch_result['sorted_file_count'], \
+                        'unmoved:', batch_result['unmoved_file_count'])
+    except KeyboardInterrupt:
+        print('Watch stopped.')
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return {
+        'sorted_file_count': sorted_file_count, \
+        'unmoved_file_count': unmoved_file_count, \
+        }
+
+def shard_arg(value=None):
+    """
+    Parse a shard given as i/N, returning (i, N).
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must be given as i/N: {value}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'shard index must be from 0 to N-1: {value}')
+    return index, count
 
 def arg_setup():
     # set up argument parser
@@ -145,42 +1999,187 @@ def arg_setup():
         help="Simulate the sort process without moving files or creating directories.")
     ap.add_argument("-f", "--force", action="store_true", \
         help="Force overwrite of existing files.")
+    ap.add_argument("--scan_workers", "--scan-workers", type=int, default=1, \
+        help="Number of threads listing directories in parallel while scanning, for network filesystems.")
+    ap.add_argument("--move_workers", "--move-workers", type=int, default=1, \
+        help="Number of threads moving files in parallel.")
+    ap.add_argument("--scan_index", action="store_true", \
+        help="Use an index in the log directory to skip listing directories unchanged since the last run.")
+    ap.add_argument("--watch", action="store_true", \
+        help="Keep running and sort files as they arrive in the input path.")
+    ap.add_argument("--verify", action="store_true", \
+        help="Hash files copied between filesystems while copying and check the copy before removing the source.")
+    ap.add_argument("--resume", \
+        help="Path to the journal of an interrupted run, finish its remaining moves without scanning again.")
+    ap.add_argument("--plan", \
+        help="Write the moves that would be made to this plan file instead of moving files.")
+    ap.add_argument("--execute", \
+        help="Move the files of a plan file written with --plan, without scanning the input path.")
+    ap.add_argument("--log_gzip", action="store_true", \
+        help="Write a gzip compressed log file.")
+    ap.add_argument("--log_db", action="store_true", \
+        help="Also log moves to an SQLite database in the log directory, indexed for url_gen.py and other readers.")
+    ap.add_argument("--preflight", action="store_true", \
+        help="Check what would fail, without moving files, and summarize the failures.")
+    ap.add_argument("--collision_policy", choices=['fail', 'dedupe'], default='fail', \
+        help="What to do when a file name exists and --force isn't given: fail, or dedupe to remove \
+        files identical to the existing file, comparing sizes then cached digests.")
+    ap.add_argument("--shard", type=shard_arg, \
+        help="Sort only shard i of N, given as i/N, so N processes can sort the same input path at once. \
+        Files are divided by destination folder number. Each shard writes its own log and log database, merge them with log_merge.py.")
+    ap.add_argument("--max_ops", type=float, \
+        help="Maximum moves per second.")
+    ap.add_argument("--max_bytes", type=float, \
+        help="Maximum bytes per second copied between filesystems.")
+    ap.add_argument("--rate_control", \
+        help="JSON file with ops_per_second and bytes_per_second limits, read again when modified or on SIGHUP.")
+    ap.add_argument("--settle_time", type=float, default=5, \
+        help="Seconds a file's size must be unchanged before it is moved in watch mode.")
     args = vars(ap.parse_args())
     return args
 
+def order_file_types(file_types=None, precedence=None):
+    """
+    Return file type names in the order their patterns are tested.
+    File types listed in precedence come first, in the order given,
+    followed by the remaining file types in config file order.
+    """
+    ordered = []
+    for file_type in precedence or []:
+        if file_type not in file_types:
+            print('WARNING - unknown file type in file_type_precedence:', file_type)
+        elif file_type not in ordered:
+            ordered.append(file_type)
+    for file_type in file_types:
+        if file_type not in ordered:
+            ordered.append(file_type)
+    return ordered
+
 def sort(input_path=None, number_pad=None, folder_increment=None, catalog_number_regex=None,\
-    collection_prefix=None, file_types=None, destination_base_path=None):
+    collection_prefix=None, file_types=None, destination_base_path=None, file_type_precedence=None, \
+    scan_workers=1, scan_index_path=None, watch_settle_time=None, move_workers=1, journal_path=None, \
+    resume=False, plan_path=None, preflight=False, digest_cache_path=None, shard=None):
     # TODO check ALL output directories before scanning for files
-    # scan, sort, and move each file type
+    # scan once for all file types, then sort and move each file
     global sorted_file_count
     global unmoved_file_count # files matching pattern, but not moved/sorted
-    for file_type, value in file_types.items():
+    classifier = FileClassifier(catalog_number_regex=catalog_number_regex, \
+        file_types=file_types, \
+        precedence=file_type_precedence, \
+        prefix=collection_prefix)
+    output_paths = {}
+    unwritable_file_types = []
+    # Patterns for all file types are kept so precedence is unchanged
+    # even when a file type can't be written to
+    for file_type, pattern in classifier.patterns:
+        print('pattern:', file_type, pattern)
+        value = file_types[file_type]
         #print('file_type', file_type, 'value', value)
-        #regex = value.get('regex', None)
-        file_regex = value.get('file_regex', None)
-        regex = catalog_number_regex + file_regex
         output_sub_path = value.get('output_sub_path', None)
         output_path = destination_base_path.joinpath(output_sub_path)
         # Check ability to write to directory
         if not os.access(output_path, os.W_OK | os.X_OK):
             #TODO log fail
             print(f'Unable to write to directory: {output_path}')
+            unwritable_file_types.append(file_type)
+        else:
+            output_paths[file_type] = output_path
+    if output_paths:
+        fingerprint = classifier_fingerprint(classifier=classifier)
+        if journal_path:
+            # a shard's journal can only be resumed by the same shard
+            journal_fingerprint = fingerprint if shard is None else f'{fingerprint} shard {shard[0]}/{shard[1]}'
+            journal = SortJournal(path=journal_path, input_path=input_path, fingerprint=journal_fingerprint, \
+                resume=resume)
+            if journal.fingerprint != journal_fingerprint:
+                print('ERROR - journal was written with different file type patterns or shard:', journal_path)
+                journal.close()
+                return
+        else:
+            journal = None
+        if scan_index_path:
+            index = ScanIndex(path=scan_index_path, fingerprint=fingerprint)
         else:
-            file_matches = scan_files(path=input_path, pattern=regex, file_type=file_type)
-            sort_result = sort_files(files=file_matches, \
-                number_pad=number_pad, \
-                folder_increment=folder_increment, \
-                collection_prefix=collection_prefix, \
-                output_path=output_path)
-            sorted_file_count += sort_result.get('sorted_file_count', 0)
-            unmoved_file_count += sort_result.get('unmoved_file_count', 0)
+            index = None
+        planner = DestinationPlanner(number_pad=number_pad, \
+            folder_increment=folder_increment, \
+            collection_prefix=collection_prefix, \
+            output_paths=output_paths, \
+            create_directories=not (dry_run or plan_path or preflight), \
+            shard=shard)
+        digests = DigestCache(path=digest_cache_path) if digest_cache_path else None
+        collisions = CollisionDetector(digests=digests)
+        manifests = ChecksumManifests(file_types=[file_type for file_type in output_paths \
+            if file_types[file_type].get('manifest', False)])
+        try:
+            if preflight:
+                # directories are listed again rather than reused from the scan index, to check them as they are now
+                checks = Preflight(output_paths=output_paths, unwritable_file_types=unwritable_file_types, \
+                    force_overwrite=settings.force_overwrite, planner=planner)
+                file_matches = buffered(scan_files(path=input_path, classifier=classifier, \
+                    workers=scan_workers, preflight=checks))
+                sort_result = checks.check(files=planner.plan(files=file_matches), collisions=collisions)
+                checks.report()
+            elif watch_settle_time:
+                sort_result = watch_files(input_path=input_path, \
+                    classifier=classifier, \
+                    index=index, \
+                    scan_workers=scan_workers, \
+                    settle_time=watch_settle_time, \
+                    planner=planner, \
+                    collisions=collisions, \
+                    move_workers=move_workers, \
+                    manifests=manifests)
+            else:
+                # Each stage passes files on as they are found, scanning and moving
+                # run in their own threads with bounded queues between the stages
+                if resume:
+                    file_matches = resume_files(journal=journal, classifier=classifier, \
+                        workers=scan_workers, index=index)
+                else:
+                    file_matches = scan_files(path=input_path, classifier=classifier, \
+                        workers=scan_workers, index=index, markers=journal is not None)
+                file_matches = buffered(file_matches)
+                # planning runs ahead of the moves so destination directories
+                # are created before the first file for them is moved
+                planned_files = planner.plan(files=file_matches)
+                if journal is not None:
+                    # files are recorded before they are moved
+                    planned_files = journal.record_plans(files=planned_files)
+                planned_files = buffered(planned_files)
+                if plan_path:
+                    collision_counts = write_plan(files=planned_files, plan_path=plan_path, collisions=collisions)
+                    print('planned files', sum(collision_counts.values()), 'new', collision_counts['new'], \
+                        'existing', collision_counts['exists'], 'duplicate', collision_counts['duplicate'])
+                    return
+                move_results = buffered(sort_files(files=planned_files, planner=planner, collisions=collisions, \
+                    workers=move_workers, manifests=manifests))
+                sort_result = log_moves(move_results=move_results, journal=journal)
+        finally:
+            planner.close()
+            manifests.close()
+            if index is not None:
+                index.close()
+            if journal is not None:
+                journal.close()
+            if digests is not None:
+                digests.close()
+        if verbose:
+            print('destination directories', len(planner.destination_directories), \
+                'listed for collisions', collisions.listed_count)
+            if digests is not None:
+                print('files hashed', digests.hashed_count, 'digests reused from cache', digests.cached_count)
+        sorted_file_count += sort_result.get('sorted_file_count', 0)
+        unmoved_file_count += sort_result.get('unmoved_file_count', 0)
 
 class Settings():
-    def __init__(self, prefix=None, dry_run=None, verbose=None, force_overwrite=None):
+    def __init__(self, prefix=None, dry_run=None, verbose=None, force_overwrite=None, scan_workers=1, move_workers=1):
         self.prefix = prefix
         self.dry_run = dry_run
         self.verbose = verbose
         self.force_overwrite = force_overwrite
+        self.scan_workers = scan_workers
+        self.move_workers = move_workers
 
     def load_config(self, config_file=None):
         # load config file
@@ -200,8 +2199,11 @@ class Settings():
                 self.output_base_path = Path(self.files.get('output_base_path', None))
                 # Get the type of files and patterns that will be scanned and sorted
                 self.file_types = config.get('file_types', None)
+                # Optional ordering used when a file matches more than one file type
+                self.file_type_precedence = config.get('file_type_precedence', None)
     
 if __name__ == '__main__':
+    print('STARTING')
     # initialize settings
     # set up argparse
     args = arg_setup()
@@ -211,6 +2213,23 @@ if __name__ == '__main__':
     verbose = args['verbose']
     force_overwrite = args['force']
     input_path_override = args['input_path']
+    scan_workers = args['scan_workers']
+    move_workers = args['move_workers']
+    use_scan_index = args['scan_index']
+    watch = args['watch']
+    settle_time = args['settle_time']
+    verify = args['verify']
+    resume_journal = args['resume']
+    plan_path = args['plan']
+    log_gzip = args['log_gzip']
+    log_db = args['log_db']
+    preflight = args['preflight']
+    collision_policy = args['collision_policy']
+    shard = args['shard']
+    max_ops = args['max_ops']
+    max_bytes = args['max_bytes']
+    rate_control = args['rate_control']
+    execute_path = args['execute']
 
     """
     #TODO reactivate input path override
@@ -242,7 +2261,8 @@ if __name__ == '__main__':
             force_overwrite_confirmed = False
             sys.exit()
 
-    settings = Settings(dry_run=dry_run, verbose=verbose, force_overwrite=force_overwrite_confirmed)
+    settings = Settings(dry_run=dry_run, verbose=verbose, force_overwrite=force_overwrite_confirmed, \
+        scan_workers=scan_workers, move_workers=move_workers)
     #Load settings from config
     settings.load_config(config_file=config_file)
 
@@ -256,8 +2276,26 @@ if __name__ == '__main__':
     log_filename = settings.collection_prefix + '_' + str(now.strftime('%Y-%m-%dT%H%M%S'))
     if dry_run:
         log_filename = log_filename + '_DRY-RUN'
+    elif preflight:
+        log_filename = log_filename + '_PREFLIGHT'
+    if shard:
+        # each shard keeps its own log, log database, journal, scan index and digest cache
+        shard_name = f'_shard{shard[0]}of{shard[1]}'
+        log_filename = log_filename + shard_name
+    else:
+        shard_name = ''
+    log_name = log_filename
     log_filename = log_filename + '.csv'
+    if log_gzip:
+        log_filename = log_filename + '.gz'
     log_file_path = settings.log_directory_path.joinpath(log_filename)
+    # the journal of a run is kept next to its log, a resumed run adds to the journal it resumes
+    if resume_journal:
+        journal_path = Path(resume_journal)
+    elif dry_run or watch or plan_path or execute_path or preflight:
+        journal_path = None
+    else:
+        journal_path = settings.log_directory_path.joinpath(log_name + '.journal')
 
     # get current username
     try:
@@ -266,32 +2304,87 @@ if __name__ == '__main__':
         print('ERROR - Unable to retrive username.')
         username = 'None'
     
-    csvfile = open(log_file_path, 'w', newline='')
-    fieldnames = ['timestamp', 'username', 'action', 'result', 'details', 'filetype', 'source', 'destination']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
+    # planning writes a plan file instead of a log
+    if plan_path:
+        writer = None
+    else:
+        fieldnames = ['timestamp', 'username', 'action', 'result', 'details', 'filetype', 'source', 'destination', \
+            'move_method', 'bytes_copied', 'sha256']
+        if log_db:
+            log_database_path = settings.log_directory_path.joinpath(settings.collection_prefix + '_log' \
+                + shard_name + '.sqlite')
+        else:
+            log_database_path = None
+        writer = LogWriter(path=log_file_path, fieldnames=fieldnames, compress=log_gzip, \
+            database=log_database_path, run_id=log_name)
 
     input_path = Path(settings.files.get('input_path', None))
+    if use_scan_index:
+        scan_index_path = settings.log_directory_path.joinpath(settings.collection_prefix + '_scan_index' \
+            + shard_name + '.sqlite')
+    else:
+        scan_index_path = None
+    if collision_policy == 'dedupe':
+        digest_cache_path = settings.log_directory_path.joinpath(settings.collection_prefix + '_digests' \
+            + shard_name + '.sqlite')
+    else:
+        digest_cache_path = None
     #print(settings.catalog_number_regex)
     
+    if max_ops or max_bytes or rate_control:
+        rate_limiter = RateLimiter(ops_per_second=max_ops, bytes_per_second=max_bytes, control_path=rate_control)
+        if rate_control:
+            # re-read the control file on kill -HUP
+            signal.signal(signal.SIGHUP, rate_limiter.request_reload)
+    else:
+        rate_limiter = None
+
+    if watch:
+        # stop watching cleanly when the job is terminated
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     # verify path exists before starting
     try:
         os.path.isdir(input_path)
         # start sorting
-        sort(input_path=input_path, \
-            number_pad=settings.number_pad, \
-            folder_increment=settings.folder_increment, \
-            catalog_number_regex=settings.catalog_number_regex,\
-            collection_prefix=settings.collection_prefix, \
-            file_types=settings.file_types, \
-            destination_base_path=settings.output_base_path)
+        if execute_path:
+            execute_plan(plan_path=execute_path, move_workers=settings.move_workers, \
+                manifest_file_types=[file_type for file_type, value in settings.file_types.items() \
+                    if value.get('manifest', False)], \
+                digest_cache_path=digest_cache_path)
+        else:
+            sort(input_path=input_path, \
+                number_pad=settings.number_pad, \
+                folder_increment=settings.folder_increment, \
+                catalog_number_regex=settings.catalog_number_regex,\
+                collection_prefix=settings.collection_prefix, \
+                file_types=settings.file_types, \
+                destination_base_path=settings.output_base_path, \
+                file_type_precedence=settings.file_type_precedence, \
+                scan_workers=settings.scan_workers, \
+                scan_index_path=scan_index_path, \
+                watch_settle_time=settle_time if watch else None, \
+                move_workers=settings.move_workers, \
+                journal_path=journal_path, \
+                resume=bool(resume_journal), \
+                plan_path=plan_path, \
+                preflight=preflight, \
+                digest_cache_path=digest_cache_path, \
+                shard=shard)
     except:
         print('Input_path was not valid.')
               
-    csvfile.close()
     # Summary report
     print('SORT COMPLETE')
-    if verbose:
-        print('sorted_file_count', sorted_file_count)
-        print('unmoved_file_count', unmoved_file_count)
-    print('Log file written to:', log_file_path)
+    if plan_path:
+        print('Plan file written to:', plan_path)
+    else:
+        writer.close()
+        if rate_limiter is not None:
+            rate_limiter.report()
+        if verbose:
+            print('sorted_file_count', sorted_file_count)
+            print('unmoved_file_count', unmoved_file_count)
+        print('Log file written to:', log_file_path)
+        if log_database_path:
+            print('Log database written to:', log_database_path, 'run_id', log_name)
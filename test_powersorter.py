@@ -0,0 +1,46 @@
+"""
+Tests for powersorter.py, run with pytest.
+"""
+
+import json
+
+import powersorter
+
+CATALOG_NUMBER_REGEX = r'(?P<catNum>(?P<instID>BRIT)(?P<numerical>\d+))'
+FILE_TYPES = {'web_jpg': {'file_regex': r'(\.)(?P<ext>jpg)'}}
+
+def make_classifier():
+    return powersorter.FileClassifier(catalog_number_regex=CATALOG_NUMBER_REGEX, \
+        file_types=FILE_TYPES, precedence=['web_jpg'])
+
+def write_journal(path=None, records=None):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+def test_resume_interrupted_directory(tmp_path):
+    """
+    A run killed partway through a directory's plans scans that directory again
+    on resume, each file left to move is yielded once.
+    """
+    input_path = tmp_path / 'in'
+    directory = input_path / 'batch'
+    directory.mkdir(parents=True)
+    names = [f'BRIT{n}.jpg' for n in range(10)]
+    for name in names[3:]:
+        (directory / name).write_text('x')
+    # files 0-2 were moved, 3-5 planned and not moved, 6-9 not planned before the run was killed
+    journal_path = tmp_path / 'run.journal'
+    write_journal(path=journal_path, records=[
+        ['start', str(input_path), 'fingerprint'],
+        ['scanned', str(input_path), [str(directory)]],
+        ] + [['plan', str(directory), name, 'web_jpg'] for name in names[:6]] \
+        + [['done', str(directory / name)] for name in names[:3]])
+
+    journal = powersorter.SortJournal(path=journal_path, input_path=input_path, resume=True)
+    try:
+        files = [file.file_path for file in powersorter.resume_files(journal=journal, classifier=make_classifier()) \
+            if not isinstance(file, powersorter.ScannedDirectory)]
+    finally:
+        journal.close()
+    assert sorted(files) == sorted(str(directory / name) for name in names[3:])
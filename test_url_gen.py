@@ -0,0 +1,71 @@
+"""
+Tests for url_gen.py, run with pytest.
+"""
+
+import pytest
+
+import url_gen
+
+WEB_BASE = '/corral/web/TORCH'
+URL_BASE = 'https://example.org/torch/'
+
+FILE_PATHS = [
+    # under web_base
+    '/corral/web/TORCH/BRIT0001000/BRIT1234.jpg',
+    '/corral/web/TORCH/BRIT0001000/BRIT1234_med.jpg',
+    '/corral/web/TORCH/BRIT1234.jpg',
+    '/corral/web/TORCH/a/b/c/BRIT1234_thumb.jpg',
+    # doubled and trailing slashes
+    '/corral/web//TORCH/BRIT0001000/BRIT1234.jpg',
+    '/corral/web/TORCH//BRIT0001000//BRIT1234.jpg',
+    '/corral/web/TORCH/BRIT0001000/',
+    '/corral/web/TORCH/BRIT0001000/BRIT1234.jpg/',
+    # outside web_base
+    '/corral/web/TORCHES/BRIT1234.jpg',
+    '/corral/other/BRIT1234.jpg',
+    '/elsewhere/deep/path/BRIT1234.jpg',
+    '/BRIT1234.jpg',
+    # web_base's parent and its ancestors, where the file name can be part of the common path
+    '/corral/web/TORCH',
+    '/corral/web/BRIT1234.jpg',
+    '/corral/BRIT1234.jpg',
+    '/corral/web',
+    # names urljoin treats specially, and dot names
+    '/corral/web/TORCH/BRIT0001000/BRIT1234;v=1.jpg',
+    '/corral/web/TORCH/BRIT0001000/BRIT1234?.jpg',
+    '/corral/web/TORCH/BRIT0001000/BRIT#1234.jpg',
+    '/corral/web/TORCH/BRIT0001000/c:BRIT1234.jpg',
+    '/corral/web/TORCH/BRIT0001000/.',
+    '/corral/web/TORCH/BRIT0001000/..',
+    '/corral/web/TORCH/BRIT0001000/.BRIT1234.jpg',
+    '/corral/web/TORCH/../TORCH/BRIT1234.jpg',
+    '/corral/web/TORCH/./BRIT1234.jpg',
+    ]
+
+@pytest.mark.parametrize('web_base', [WEB_BASE, WEB_BASE + '/', WEB_BASE + '//', '/'])
+@pytest.mark.parametrize('url_base', [URL_BASE, URL_BASE.rstrip('/'), 'https://example.org/'])
+def test_url_translator_matches_generate_url(web_base, url_base):
+    url_translator = url_gen.UrlTranslator(web_base=web_base, url_base=url_base)
+    # each path is translated twice, before and after its directory's prefix is cached
+    for file_path in FILE_PATHS + FILE_PATHS:
+        assert url_translator.url(file_path=file_path) \
+            == url_gen.generate_url(file_base_path=web_base, file_path=file_path, url_base=url_base), file_path
+
+def test_url_translator_relative_paths():
+    url_translator = url_gen.UrlTranslator(web_base='web/TORCH/', url_base=URL_BASE)
+    for file_path in ['web/TORCH/BRIT0001000/BRIT1234.jpg', 'web/other/BRIT1234.jpg', 'web/TORCH/../x/BRIT1.jpg']:
+        assert url_translator.url(file_path=file_path) \
+            == url_gen.generate_url(file_base_path='web/TORCH/', file_path=file_path, url_base=URL_BASE)
+
+def test_url_translator_mixed_paths_raise_like_generate_url():
+    url_translator = url_gen.UrlTranslator(web_base=WEB_BASE, url_base=URL_BASE)
+    with pytest.raises(ValueError):
+        url_gen.generate_url(file_base_path=WEB_BASE, file_path='BRIT0001000/BRIT1234.jpg', url_base=URL_BASE)
+    with pytest.raises(ValueError):
+        url_translator.url(file_path='BRIT0001000/BRIT1234.jpg')
+
+def test_url_translator_caches_directory_prefix():
+    url_translator = url_gen.UrlTranslator(web_base=WEB_BASE, url_base=URL_BASE)
+    url_translator.url(file_path='/corral/web/TORCH/BRIT0001000/BRIT1234.jpg')
+    url_translator.url(file_path='/corral/web/TORCH/BRIT0001000/BRIT1235.jpg')
+    assert url_translator.prefixes == {'/corral/web/TORCH/BRIT0001000': 'https://example.org/torch/TORCH/BRIT0001000/'}
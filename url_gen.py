@@ -16,42 +16,66 @@ import os.path
 from urllib.parse import urljoin
 from pathlib import Path
 import json
+import datetime
+import sys
+import sqlite3
+import gzip
+import glob
+import concurrent.futures
+import heapq
+import itertools
+import tempfile
+
+import powersorter
 
 #FILE_BASE_PATH = '/corral-repl/projects/TORCH/web/'
 #URL_BASE = 'https://web.corral.tacc.utexas.edu/torch/'
 DEFAULT_THUMB_EXT = '_thumb'
 DEFAULT_MEDIUM_EXT = '_med'
 
-# set up argument parser
-ap = argparse.ArgumentParser()
-ap.add_argument("-i", "--input", required=True, \
-    help="Path to the input log file generated by powersort.py.")
-ap.add_argument("-c", "--config", required=True, \
-    help="Configuration file path with required parameters.")
-ap.add_argument("-m", "--med_tag", required=False, \
-    help="Tag used to indicate a medium image (e.g. _med)")
-ap.add_argument("-t", "--thumb_tag", required=False, \
-    help="Tag used to indicate a thumbnail image (e.g. _thumb)")
-ap.add_argument("-v", "--verbose", action="store_true", \
-    help="Detailed output.")
-args = vars(ap.parse_args())
-
-input_file = args['input']
-config_file = args['config']
-verbose = args['verbose']
-#file_prefix = args["prefix"]
 # v3, v2, and v1 file types
 # once regex is exclusivly used, these file type will not be needed
 web_file_types = ['web', 'web_derivs', 'web_jpg_med', 'web_jpg_thumb', 'web_jpg'] # file types that will have url generated
-if args["thumb_tag"]:
-    thumb_ext = args["thumb_tag"]
-else:
-    thumb_ext = DEFAULT_THUMB_EXT
+# file types matched by regex, in the order their patterns are tested
+WEB_IMAGE_FILE_TYPES = ['web_jpg', 'web_jpg_med', 'web_jpg_thumb']
+# output column for each size class matched by the web image patterns
+SIZE_FIELDS = {'thumb': 'thumbnail', 'med': 'web', 'large': 'large'}
+# columns of the URL mapping file
+URL_FIELDNAMES = ['catalog_number', 'large', 'web', 'thumbnail']
+# appended to the collection prefix to name the --incremental state database
+STATE_FILENAME_SUFFIX = '_url_state.sqlite'
+# log rows or image sets held in memory by --streaming before spilling to a temporary file
+STREAMING_CHUNK_ROWS = 200000
 
-if args["med_tag"]:
-    medium_ext = args["med_tag"]
-else:
-    medium_ext = DEFAULT_MEDIUM_EXT
+def arg_setup():
+    # set up argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--input", required=True, nargs="+", \
+        help="Paths or glob patterns of input log files generated by powersort.py, CSV logs or SQLite log databases (.sqlite). " \
+        + "URLs from several logs are merged, the latest row by timestamp wins.")
+    ap.add_argument("-o", "--output", required=False, \
+        help="Path of the URL mapping file, required for more than one log. Defaults to the log name with _urls.csv.")
+    ap.add_argument("-w", "--workers", type=int, required=False, \
+        help="Number of processes parsing logs when there are several, defaults to the number of CPUs.")
+    ap.add_argument("-r", "--run_id", required=False, \
+        help="Run ID of the powersorter run to read from an SQLite log database, all runs if not given.")
+    ap.add_argument("-c", "--config", required=True, \
+        help="Configuration file path with required parameters.")
+    ap.add_argument("-m", "--med_tag", required=False, \
+        help="Tag used to indicate a medium image (e.g. _med)")
+    ap.add_argument("-t", "--thumb_tag", required=False, \
+        help="Tag used to indicate a thumbnail image (e.g. _thumb)")
+    ap.add_argument("-s", "--streaming", action="store_true", \
+        help="Group image sets with an external sort using temporary files, keeping memory use bounded for large logs.")
+    ap.add_argument("--incremental", action="store_true", \
+        help="Only write image sets that are new or whose URLs changed since they were last exported with --incremental.")
+    ap.add_argument("--state", required=False, \
+        help="Path of the SQLite database of exported URLs used by --incremental. " \
+        + "Defaults to the collection prefix with " + STATE_FILENAME_SUFFIX + " in the log directory of the config file.")
+    ap.add_argument("-v", "--verbose", action="store_true", \
+        help="Detailed output.")
+    args = vars(ap.parse_args())
+    return args
 
 class Settings():
     def __init__(self, verbose=False):
@@ -77,6 +101,8 @@ class Settings():
                 self.web_jpg_regex = self.file_types.get('web_jpg', None).get('file_regex', None)
                 self.web_jpg_med_regex = self.file_types.get('web_jpg_med', None).get('file_regex', None)
                 self.web_jpg_thumb_regex = self.file_types.get('web_jpg_thumb', None).get('file_regex', None)
+                self.files = config.get('files', None) or {}
+                self.log_directory_path = self.files.get('log_directory_path', None)
                 #self.catalog_number_regex = self.collection.get('catalog_number_regex', None)
                 #self.files = config.get('files', None)
                 #self.folder_increment = int(self.files.get('folder_increment', 1000))
@@ -86,6 +112,39 @@ class Settings():
                 # Get the type of files and patterns that will be scanned and sorted
                 #self.file_types = config.get('file_types', None)
 
+def is_log_database(log_path=None):
+    return Path(log_path).suffix in ('.sqlite', '.db')
+
+def read_log(log_path=None, run_id=None):
+    """
+    Yield the rows of a powersorter log as dicts.
+    An SQLite log database only returns the rows of successful moves, optionally of
+    one run, using its indexes. Dry runs and preflights logged to the same
+    database are left out. Rows are returned in the order they were logged.
+    CSV logs may be gzip compressed.
+    """
+    if is_log_database(log_path):
+        connection = sqlite3.connect(log_path)
+        connection.row_factory = sqlite3.Row
+        query = "SELECT timestamp, destination, filetype, result FROM moves WHERE result = 'success' AND action = 'move'"
+        parameters = []
+        if run_id:
+            query += ' AND run_id = ?'
+            parameters.append(run_id)
+        try:
+            for row in connection.execute(query + ' ORDER BY rowid', parameters):
+                yield dict(row)
+        finally:
+            connection.close()
+    else:
+        if Path(log_path).suffix == '.gz':
+            csvfile = gzip.open(log_path, 'rt', newline='')
+        else:
+            csvfile = open(log_path, newline='')
+        with csvfile:
+            reader = csv.DictReader(csvfile)
+            yield from reader
+
 def generate_url(file_base_path=None, file_path=None, url_base=None):
     """
     Generate a URL using the file paths and URL base path.
@@ -107,6 +166,50 @@ def generate_url(file_base_path=None, file_path=None, url_base=None):
     """
     return image_url
 
+class UrlTranslator():
+    """
+    Translate file paths into the same URLs as generate_url, for one web_base and url_base.
+    The URL prefix of each parent directory is worked out once with generate_url's
+    path logic, so translating a file is a lookup and one concatenation.
+    """
+    # file name characters urljoin would not treat as part of a plain path segment
+    UNSAFE_NAME_CHARACTERS = frozenset(';?#:')
+
+    def __init__(self, web_base=None, url_base=None):
+        self.web_base = web_base
+        self.url_base = url_base
+        self.prefixes = {} # parent directory: URL prefix, None if generate_url is used
+
+    def directory_prefix(self, directory=None):
+        """
+        Return the URL prefix of the files in directory.
+        Returns None for web_base's parent directory and its ancestors, where a
+        file name can be part of the common path with web_base.
+        """
+        common_path = os.path.commonpath([self.web_base, directory])
+        if common_path == os.path.commonpath([directory]) \
+            and common_path != os.path.commonpath([self.web_base]):
+            return None
+        web_base_parent_path, common_dirname = os.path.split(common_path)
+        relative_path = os.path.relpath(directory, start=web_base_parent_path)
+        if relative_path == '.':
+            return None
+        return urljoin(self.url_base, relative_path + '/')
+
+    def url(self, file_path=None):
+        directory, file_name = os.path.split(file_path)
+        try:
+            prefix = self.prefixes[directory]
+        except KeyError:
+            prefix = None
+            if directory:
+                prefix = self.directory_prefix(directory=directory)
+            self.prefixes[directory] = prefix
+        if prefix is None or file_name in ('', '.', '..') \
+            or not self.UNSAFE_NAME_CHARACTERS.isdisjoint(file_name):
+            return generate_url(file_base_path=self.web_base, file_path=file_path, url_base=self.url_base)
+        return prefix + file_name
+
 def generate_url_records(file_base_path=None, url_base=None):
     """
     This method does not account for suffixes. They will overwrite or be 
@@ -115,59 +218,99 @@ def generate_url_records(file_base_path=None, url_base=None):
     relies on the powersort input field 'filetype'.
     """
     occurrence_set = {}
-    with open(input_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            file_path = row['destination']
-            file_type = row['filetype']
-            result_status = row['result']
-            # check if file successfully moved
-            if result_status == 'success':
-                if file_type in web_file_types:
-                    # get filename parts
-                    file_path_obj = Path(file_path)
-                    basename = file_path_obj.name
-                    file_name = file_path_obj.stem
-                    file_extension = file_path_obj.suffix
-                    try:
-                        catalog_number = catalog_number_pattern.match(file_name).group(0)
-                        # Create catalog number record if it doesn't exist
-                        if catalog_number not in occurrence_set:
-                            occurrence_set[catalog_number]={'catalog_number': catalog_number}
-                        # Determine if thumbnail, original, or web size
-                        if file_name.endswith(thumb_ext):
-                            occurrence_set[catalog_number]['thumbnail'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
-                        elif file_name.endswith(medium_ext):
-                            occurrence_set[catalog_number]['web'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
-                        else:
-                            occurrence_set[catalog_number]['large'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
-                    except AttributeError:
-                        print(f'No match for file_name {file_name} with prefix {file_prefix}')
+    for row in read_log(log_path=input_file, run_id=run_id):
+        file_path = row['destination']
+        file_type = row['filetype']
+        result_status = row['result']
+        # check if file successfully moved
+        if result_status == 'success':
+            if file_type in web_file_types:
+                # get filename parts
+                file_path_obj = Path(file_path)
+                basename = file_path_obj.name
+                file_name = file_path_obj.stem
+                file_extension = file_path_obj.suffix
+                try:
+                    catalog_number = catalog_number_pattern.match(file_name).group(0)
+                    # Create catalog number record if it doesn't exist
+                    if catalog_number not in occurrence_set:
+                        occurrence_set[catalog_number]={'catalog_number': catalog_number}
+                    # Determine if thumbnail, original, or web size
+                    if file_name.endswith(thumb_ext):
+                        occurrence_set[catalog_number]['thumbnail'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
+                    elif file_name.endswith(medium_ext):
+                        occurrence_set[catalog_number]['web'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
+                    else:
+                        occurrence_set[catalog_number]['large'] = generate_url(file_path=file_path, file_base_path=file_base_path, url_base=url_base)
+                except AttributeError:
+                    print(f'No match for file_name {file_name} with prefix {file_prefix}')
     return occurrence_set
 
-def match_pattern(text=None, settings=None):
-    web_jpg_pattern = re.compile(settings.catalog_number_regex + settings.web_jpg_regex)
-    web_jpg_med_pattern = re.compile(settings.catalog_number_regex + settings.web_jpg_med_regex)
-    web_jpg_thumb_pattern = re.compile(settings.catalog_number_regex + settings.web_jpg_thumb_regex)
-
-    # test image patterns
-    match = None
-    match_dict = None
-    full = web_jpg_pattern.match(text)
-    medium = web_jpg_med_pattern.match(text)
-    thumb = web_jpg_thumb_pattern.match(text)
-
-    if full:
-        match = full
-    elif medium:
-        match = medium
-    elif thumb:
-        match = thumb
-    if match:
-        match_dict = match.groupdict()
-    return match_dict
+class WebImageClassifier():
+    """
+    Classify web image file names using the web_jpg, web_jpg_med and web_jpg_thumb
+    patterns, compiled once into a single pattern by powersorter's FileClassifier.
+    The first pattern to match, in that order, determines the result.
+    """
+    def __init__(self, settings=None):
+        file_types = {file_type: settings.file_types[file_type] for file_type in WEB_IMAGE_FILE_TYPES}
+        self.classifier = powersorter.FileClassifier(catalog_number_regex=settings.catalog_number_regex, \
+            file_types=file_types, \
+            precedence=WEB_IMAGE_FILE_TYPES, \
+            prefix=settings.collection_prefix)
+
+    def match(self, text=None):
+        """
+        Return the size class and groupdict of a file name, or None if it doesn't match.
+        The size class is the size group of the matching pattern, 'large' if it has none.
+        """
+        result = self.classifier.match(text)
+        if result is None:
+            return None
+        file_type, match_dict = result
+        return match_dict.get('size', 'large'), match_dict
 
 
+def image_set_urls(settings=None, log_path=None, run_id=None):
+    """
+    Yield (image_set, catalog_number, size_field, url, timestamp) for each successful move
+    in the log matching a web image pattern, in log order.
+    size_field is the output column of the image size and url is None when
+    the size is not one of the output columns.
+    """
+    image_classifier = WebImageClassifier(settings=settings)
+    url_translator = UrlTranslator(web_base=settings.web_base, url_base=settings.url_base)
+    for row in read_log(log_path=log_path, run_id=run_id):
+        file_path = row['destination']
+        file_type = row['filetype']
+        result_status = row['result']
+        # check if file successfully moved
+        if result_status == 'success':
+            # get filename parts
+            file_path_obj = Path(file_path)
+            basename = file_path_obj.name
+            file_name = file_path_obj.stem
+            file_extension = file_path_obj.suffix
+
+            # Determine if thumbnail, original, or web size
+            result = image_classifier.match(text=basename)
+            if result:
+                size, match_dict = result
+                catalog_number = match_dict['catNum']
+                suffix = match_dict.get('suffix', None)
+                if suffix:
+                    image_set = catalog_number + '_' + suffix
+                else:
+                    image_set = catalog_number
+                size_field = SIZE_FIELDS.get(size, None)
+                url = None
+                if size_field:
+                    url = url_translator.url(file_path=file_path)
+                yield image_set, catalog_number, size_field, url, row.get('timestamp', None) or ''
+            else:
+                if settings.verbose:
+                    print('No match:', basename)
+
 def generate_url_records_suffixes(settings=None):
     """
     This method accounts for suffixes. They will be grouped into a 
@@ -177,52 +320,233 @@ def generate_url_records_suffixes(settings=None):
 
     """
     occurrence_set = {}
-    with open(input_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            file_path = row['destination']
-            file_type = row['filetype']
-            result_status = row['result']
-            # check if file successfully moved
-            if result_status == 'success':
-                # get filename parts
-                file_path_obj = Path(file_path)
-                basename = file_path_obj.name
-                file_name = file_path_obj.stem
-                file_extension = file_path_obj.suffix
+    for image_set, catalog_number, size_field, url, timestamp \
+        in image_set_urls(settings=settings, log_path=input_file, run_id=run_id):
+        # Create image_set record if it doesn't exist
+        if image_set not in occurrence_set:
+            occurrence_set[image_set]={'catalog_number': catalog_number}
+        if size_field:
+            occurrence_set[image_set][size_field] = url
+    return occurrence_set
 
-                # Determine if thumbnail, original, or web size
-                result = match_pattern(text=basename, settings=settings)
-                if result:
-                    catalog_number = result['catNum']
-                    suffix = result.get('suffix', None)
-                    size = result.get('size', 'large')
-                    if suffix:
-                        image_set = catalog_number + '_' + suffix
-                    else:
-                        image_set = catalog_number
-                    # Create image_set record if it doesn't exist
-                    if image_set not in occurrence_set:
-                        occurrence_set[image_set]={'catalog_number': catalog_number}
-                        #print(catalog_number)
-                    if size == 'thumb':
-                        occurrence_set[image_set]['thumbnail'] = generate_url(url_base=settings.url_base, file_base_path=settings.web_base, file_path=file_path)
-                    if size == 'med':
-                        occurrence_set[image_set]['web'] = generate_url(url_base=settings.url_base, file_base_path=settings.web_base, file_path=file_path)
-                    if size == 'large':
-                        occurrence_set[image_set]['large'] = generate_url(url_base=settings.url_base, file_base_path=settings.web_base, file_path=file_path)
-                else:
-                    if settings.verbose:
-                        print('No match:', basename)
+def spill_chunk(chunk=None, temp_dir=None):
+    """
+    Write a sorted chunk of rows to a temporary file, one JSON list per line,
+    and return its path.
+    """
+    chunk_file = tempfile.NamedTemporaryFile('w', dir=temp_dir, suffix='.jsonl', delete=False)
+    with chunk_file:
+        for row in chunk:
+            chunk_file.write(json.dumps(row) + '\n')
+    return chunk_file.name
+
+def read_chunk(chunk_path=None):
+    with open(chunk_path) as chunk_file:
+        for line in chunk_file:
+            yield json.loads(line)
+
+def external_sort(rows=None, key=None, chunk_rows=None, temp_dir=None):
+    """
+    Yield rows, lists of JSON values, sorted by key while holding at most
+    chunk_rows of them in memory.
+    Sorted chunks are spilled to temp_dir and merged as they are read back.
+    Rows are only spilled when there are more than chunk_rows.
+    """
+    chunk_paths = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            chunk.sort(key=key)
+            chunk_paths.append(spill_chunk(chunk=chunk, temp_dir=temp_dir))
+            chunk = []
+    chunk.sort(key=key)
+    if not chunk_paths:
+        yield from chunk
+        return
+    chunks = [read_chunk(chunk_path=chunk_path) for chunk_path in chunk_paths]
+    # the last chunk stays in memory
+    chunks.append(chunk)
+    yield from heapq.merge(*chunks, key=key)
 
+def generate_url_records_streaming(settings=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    """
+    Yield the same (image_set, record) pairs as generate_url_records_suffixes,
+    in the same order, holding at most chunk_rows log rows or image sets in memory.
+    Rows are sorted by image set and log order to group them, then the
+    grouped records are sorted back into the order each image set was first seen.
+    Both sorts spill to temporary files.
+    """
+    with tempfile.TemporaryDirectory(prefix='url_gen_') as temp_dir:
+        rows = ([image_set, sequence, catalog_number, size_field, url] \
+            for sequence, (image_set, catalog_number, size_field, url, timestamp) \
+            in enumerate(image_set_urls(settings=settings, log_path=input_file, run_id=run_id)))
+        rows = external_sort(rows=rows, key=lambda row: (row[0], row[1]), \
+            chunk_rows=chunk_rows, temp_dir=temp_dir)
+
+        def grouped_records():
+            for image_set, image_set_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                first_sequence = None
+                for row in image_set_rows:
+                    if first_sequence is None:
+                        # catalog number of the first row, as in generate_url_records_suffixes
+                        first_sequence = row[1]
+                        record = {'catalog_number': row[2]}
+                    if row[3]:
+                        # rows are in log order, the last url of a size wins
+                        record[row[3]] = row[4]
+                yield [first_sequence, image_set, record]
+
+        records = external_sort(rows=grouped_records(), key=lambda row: row[0], \
+            chunk_rows=chunk_rows, temp_dir=temp_dir)
+        for first_sequence, image_set, record in records:
+            yield image_set, record
+
+def log_url_records(settings=None, log_path=None, run_id=None, log_index=None):
+    """
+    Return the image sets of one log, as generate_url_records_suffixes does,
+    with the position of each URL and of the first row of each image set.
+    A position is (timestamp, log_index, row number), so positions from
+    several logs can be compared. Runs in a worker process.
+    """
+    occurrence_set = {}
+    for sequence, (image_set, catalog_number, size_field, url, timestamp) \
+        in enumerate(image_set_urls(settings=settings, log_path=log_path, run_id=run_id)):
+        position = (timestamp, log_index, sequence)
+        if image_set not in occurrence_set:
+            occurrence_set[image_set] = {'catalog_number': catalog_number, 'first_seen': position}
+        if size_field:
+            occurrence_set[image_set][size_field] = (position, url)
     return occurrence_set
 
+def merge_url_records(log_occurrence_sets=None):
+    """
+    Merge the image sets returned by log_url_records for each log.
+    The URL of each size is taken from the latest row by timestamp, and the
+    catalog number from the earliest. Rows with the same timestamp are
+    ordered by the order the logs are given in, then by row.
+    Yields (image_set, record) in the order image sets were first seen.
+    """
+    merged = {}
+    for occurrence_set in log_occurrence_sets:
+        for image_set, record in occurrence_set.items():
+            merged_record = merged.get(image_set, None)
+            if merged_record is None:
+                merged[image_set] = record
+                continue
+            if record['first_seen'] < merged_record['first_seen']:
+                merged_record['first_seen'] = record['first_seen']
+                merged_record['catalog_number'] = record['catalog_number']
+            for size_field in SIZE_FIELDS.values():
+                if size_field in record \
+                    and (size_field not in merged_record or record[size_field][0] > merged_record[size_field][0]):
+                    merged_record[size_field] = record[size_field]
+    for image_set, record in sorted(merged.items(), key=lambda item: item[1]['first_seen']):
+        url_record = {'catalog_number': record['catalog_number']}
+        for size_field in SIZE_FIELDS.values():
+            if size_field in record:
+                url_record[size_field] = record[size_field][1]
+        yield image_set, url_record
+
+def generate_url_records_logs(settings=None, log_paths=None, workers=None):
+    """
+    Parse several logs in a process pool and merge their image sets.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        log_occurrence_sets = executor.map(log_url_records, \
+            itertools.repeat(settings), log_paths, itertools.repeat(run_id), range(len(log_paths)))
+        return list(merge_url_records(log_occurrence_sets=log_occurrence_sets))
+
+class ExportState():
+    """
+    URLs exported for each image set, kept in a SQLite database so that
+    --incremental runs only write image sets that are new or have changed.
+    Updates are only kept once commit() is called after the URL mapping file is written.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.new_count = 0
+        self.changed_count = 0
+        self.unchanged_count = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS exported (image_set TEXT PRIMARY KEY, \
+            catalog_number TEXT, large TEXT, web TEXT, thumbnail TEXT, exported TEXT)')
+        self.connection.commit()
+
+    def changes(self, records=None):
+        """
+        Yield the (image_set, record) pairs that are new or differ from the last export.
+        Sizes missing from a record keep their exported URL, so a log with only
+        some sizes of an image set still writes a complete row.
+        """
+        now = str(datetime.datetime.now())
+        for image_set, record in records:
+            record = {fieldname: value for fieldname, value in record.items() if value}
+            row = self.connection.execute('SELECT catalog_number, large, web, thumbnail FROM exported \
+                WHERE image_set = ?', (image_set,)).fetchone()
+            if row is None:
+                self.new_count += 1
+            else:
+                exported = {fieldname: value for fieldname, value in zip(URL_FIELDNAMES, row) if value}
+                record = dict(exported, **record)
+                if record == exported:
+                    self.unchanged_count += 1
+                    continue
+                self.changed_count += 1
+            self.connection.execute('INSERT OR REPLACE INTO exported (image_set, catalog_number, large, web, \
+                thumbnail, exported) VALUES (?, ?, ?, ?, ?, ?)', \
+                [image_set] + [record.get(fieldname, None) for fieldname in URL_FIELDNAMES] + [now])
+            yield image_set, record
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
 if __name__ == '__main__':
-    global settings
+    args = arg_setup()
+    log_paths = []
+    for pattern in args['input']:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        log_paths.extend(path for path in matches if path not in log_paths)
+    input_file = log_paths[0]
+    output_file_name = args['output']
+    workers = args['workers']
+    config_file = args['config']
+    verbose = args['verbose']
+    run_id = args['run_id']
+    streaming = args['streaming']
+    incremental = args['incremental']
+    state_path = args['state']
+    if len(log_paths) > 1:
+        if not output_file_name:
+            print('An --output path is required to merge more than one log.')
+            sys.exit()
+        if streaming:
+            print('--streaming reads a single log, it can\'t be used to merge logs.')
+            sys.exit()
+    #file_prefix = args["prefix"]
+    if args["thumb_tag"]:
+        thumb_ext = args["thumb_tag"]
+    else:
+        thumb_ext = DEFAULT_THUMB_EXT
+
+    if args["med_tag"]:
+        medium_ext = args["med_tag"]
+    else:
+        medium_ext = DEFAULT_MEDIUM_EXT
+
     settings = Settings(verbose=verbose)
     #Load settings from config
     settings.load_config(config_file=config_file)
     file_prefix = settings.collection_prefix
+    if incremental and not state_path:
+        # kept with the logs, so the state doesn't depend on the working directory
+        if not settings.log_directory_path:
+            print('A --state path is required when the config file has no log_directory_path.')
+            sys.exit()
+        state_path = Path(settings.log_directory_path).joinpath(file_prefix + STATE_FILENAME_SUFFIX)
     #file_base_path = settings.web_base
     url_base = settings.url_base
     web_base = settings.web_base
@@ -238,17 +562,41 @@ if __name__ == '__main__':
         print('web_base', web_base)
 
     #occurrence_set = generate_url_records(file_base_path=file_base_path, url_base=url_base)
-    occurrence_set = generate_url_records_suffixes(settings=settings)
-    #print(occurrence_set)
-    # Get input file name
-    input_file_name_stem = Path(input_file).stem
-    output_file_name = input_file_name_stem + '_urls.csv'
+    if len(log_paths) > 1:
+        print('Reading', len(log_paths), 'logs')
+        records = generate_url_records_logs(settings=settings, log_paths=log_paths, workers=workers)
+    elif streaming:
+        records = generate_url_records_streaming(settings=settings)
+    else:
+        occurrence_set = generate_url_records_suffixes(settings=settings)
+        #print(occurrence_set)
+        records = occurrence_set.items()
+    if not output_file_name:
+        # Get input file name
+        input_file_name_stem = Path(input_file).stem
+        if input_file_name_stem.endswith('.csv'):
+            # gzip compressed log
+            input_file_name_stem = Path(input_file_name_stem).stem
+        if run_id and is_log_database(input_file):
+            input_file_name_stem = run_id
+        output_file_name = input_file_name_stem + '_urls.csv'
+    if incremental:
+        print('Exported URL state:', state_path)
+        export_state = ExportState(path=state_path)
+        records = export_state.changes(records=records)
     print('Writing urls to:', output_file_name)
 
     with open(output_file_name, 'w', newline='') as csvfile:
-        fieldnames=['catalog_number', 'large', 'web', 'thumbnail']
+        fieldnames=URL_FIELDNAMES
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
-        for key, image_set in occurrence_set.items():
-            writer.writerow(image_set)
+        for image_set, record in records:
+            writer.writerow(record)
+
+    if incremental:
+        export_state.commit()
+        export_state.close()
+        print('Image sets written:', export_state.new_count + export_state.changed_count, \
+            'new:', export_state.new_count, 'changed:', export_state.changed_count, \
+            'unchanged:', export_state.unchanged_count)
 